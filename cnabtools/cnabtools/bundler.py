@@ -11,8 +11,13 @@ import subprocess
 import json
 import time
 import datetime
+import asyncio
+import hashlib
+import shutil
+import tempfile
 
-from cnabtools.docker import Docker
+from cnabtools.docker import (Docker, AsyncDocker, gather_or_cancel,
+                              inspect_images, default_image_store)
 
 
 class DuffleContext:
@@ -104,6 +109,32 @@ class DuffleContext:
                 build produces.  If "None", the bundle.json is not
                 written.
 
+        Return:
+            The content of the "bundle.json" that has been built.
+
+        Like the methods of [[Docker]], this runs an event loop of its own:
+        use [[build_cnab_app_async]] from a running event loop.
+        """
+        return asyncio.run(self.build_cnab_app_async(output_file))
+
+    async def build_cnab_app_async(self,
+                                   output_file=None,
+                                   docker=None,
+                                   on_invocation_image=None):
+        """
+        Asynchronous version of [[build_cnab_app]].  The invocation images
+        are built concurrently.
+
+        Args:
+            output_file: See [[build_cnab_app]].
+            docker: The AsyncDocker object to build the invocation images
+                with, e.g., to limit concurrency or stream build logs.  If
+                "None", a default one is used.
+            on_invocation_image: If not "None", a coroutine function that is
+                awaited with the CNAB specification of each invocation image
+                as soon as the image is built, while the other images are
+                still being built.
+
         Return:
             The content of the "bundle.json" that has been built.
         """
@@ -112,12 +143,19 @@ class DuffleContext:
         cnab_dir = os.path.join(self.duffle_context_path, 'cnab')
         app_name = duffle_manifest['name']
 
-        cnab_invocation_images = []
-        for name in duffle_manifest['invocationImages']:
-            cnab_invocation_images.append(
-                self._build_invocation_image(
-                    cnab_dir, app_name, name,
-                    duffle_manifest['invocationImages'][name]))
+        if not docker:
+            docker = self._async_docker()
+
+        async def build(name):
+            spec = await self._build_invocation_image(
+                docker, cnab_dir, app_name, name,
+                duffle_manifest['invocationImages'][name])
+            if on_invocation_image:
+                await on_invocation_image(spec)
+            return spec
+
+        cnab_invocation_images = await gather_or_cancel(
+            *[build(name) for name in duffle_manifest['invocationImages']])
 
         cnab_manifest = {
             **duffle_manifest,
@@ -130,12 +168,13 @@ class DuffleContext:
 
         return cnab_manifest
 
-    def _build_invocation_image(self, cnab_dir, app_name, manifest_name,
-                                build_spec):
+    async def _build_invocation_image(self, docker, cnab_dir, app_name,
+                                      manifest_name, build_spec):
         """
         Builds an invocation image.
 
         Args:
+            docker: The AsyncDocker object to build the image with.
             cnab_dir: The directory to the CNAB app, i.e., "<duffle context>/cnab".
             app_name: The name of the CNAB app as given in the manifest.
             manifest_name: The name of the image as given in the manifest (manifest
@@ -153,9 +192,8 @@ class DuffleContext:
                 image_full_name = (
                     build_spec['configuration']['registry'] + '/' +
                     image_full_name)
-            imgref, image_id = (
-                self._docker().build_content_addressable(
-                    cnab_dir, image_full_name))
+            imgref, image_id = (await docker.build_content_addressable(
+                cnab_dir, image_full_name))
             return {
                 'image': imgref,
                 'contentDigest': image_id,
@@ -167,9 +205,219 @@ class DuffleContext:
     def _docker(self):
         """
         Gets a Docker object to interact with Docker/Buildkit in a reproducible
-        way.
+        way.  The local image store given by the environment, if any, is used
+        (see [[default_image_store]]).
+        """
+        return Docker(image_store=default_image_store())
+
+    def _async_docker(self):
+        """
+        Gets an AsyncDocker object to interact with Docker/Buildkit in a
+        reproducible way.  The local image store given by the environment, if
+        any, is used (see [[default_image_store]]).
+        """
+        return AsyncDocker(image_store=default_image_store())
+
+
+#: Path to the folder containing the docker2 driver, when cnabtools is
+#: installed from a checkout of its repository.
+DEFAULT_DRIVERS_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'drivers',
+    'docker2')
+
+#: Files of the docker2 driver to put in thick bundles.
+DRIVER_FILES = ['cnab-docker2', 'cnab-docker2.py', 'cnab-docker2.bat']
+
+
+class ThickBundlePackager:
+    """
+    Packages a duffle context into a thick bundle: a folder with the
+    "bundle.json", the images as Docker tarballs in "images/", the "make.py"
+    and "duffle.py" scripts to install and run the application, and the
+    docker2 driver in "cnab-drivers/".
+    """
+
+    def __init__(self, duffle_context, drivers_path=None, docker=None):
         """
-        return Docker()
+        Args:
+            duffle_context: The DuffleContext to package.
+            drivers_path: The folder containing the docker2 driver (see
+                DEFAULT_DRIVERS_PATH).
+            docker: The AsyncDocker object to build and export the images
+                with.  If "None", a default one is used, with the local image
+                store given by the environment, if any (see
+                [[default_image_store]]).
+        """
+        self.duffle_context = duffle_context
+        self.drivers_path = drivers_path or DEFAULT_DRIVERS_PATH
+        self.docker = docker or AsyncDocker(image_store=default_image_store())
+
+    def package(self, output_dir):
+        """
+        Packages the thick bundle (see [[package_async]]).  Like the methods
+        of [[Docker]], this runs an event loop of its own.
+        """
+        return asyncio.run(self.package_async(output_dir))
+
+    async def package_async(self, output_dir):
+        """
+        Packages the thick bundle.
+
+        The images are exported with a single "docker save", into a single
+        Docker tarball, so that the layers they share and the images with
+        several references are stored once.  The plain images are inspected
+        while the invocation images are being built.  The tarball of an
+        existing thick bundle at the same location is reused when it is for
+        the same set of image references and image IDs.
+
+        The thick bundle is laid out in a temporary folder next to the output
+        folder, and then moved into place (see [[_replace_dir]]), so that the
+        output folder is never left half-written.
+
+        Args:
+            output_dir: The folder of the thick bundle.
+
+        Return:
+            The content of the "bundle.json" that has been built.
+        """
+        output_dir = os.path.abspath(output_dir)
+        for name in DRIVER_FILES:
+            if not os.path.exists(os.path.join(self.drivers_path, name)):
+                raise Exception(
+                    f"cannot find '{name}' in drivers path " +
+                    f"'{self.drivers_path}'")
+
+        os.makedirs(os.path.dirname(output_dir), exist_ok=True)
+        staging_dir = tempfile.mkdtemp(
+            prefix=f'.{os.path.basename(output_dir)}.',
+            dir=os.path.dirname(output_dir))
+        try:
+            os.mkdir(os.path.join(staging_dir, 'images'))
+            start = time.time()
+
+            duffle_manifest = self.duffle_context.read_manifest()
+            image_specs = list(duffle_manifest.get('images', {}).values())
+            cnab_manifest, image_ids = await gather_or_cancel(
+                self.duffle_context.build_cnab_app_async(docker=self.docker),
+                gather_or_cancel(
+                    *[self._image_id(spec) for spec in image_specs]))
+            for spec in cnab_manifest['invocationImages']:
+                image_specs.append(spec)
+                image_ids.append(await self._image_id(spec))
+
+            imgrefs_by_image_id = {}
+            for spec, image_id in zip(image_specs, image_ids):
+                imgrefs_by_image_id.setdefault(image_id,
+                                               set()).add(spec['image'])
+            await self._export_images(imgrefs_by_image_id, output_dir,
+                                      staging_dir)
+            delta = datetime.timedelta(seconds=time.time() - start)
+            print(f'{len(image_specs)} images built and exported in {delta}')
+
+            with open(os.path.join(staging_dir, 'bundle.json'), 'w') as f:
+                f.write(canonical_json(cnab_manifest))
+            package_dir = os.path.dirname(os.path.abspath(__file__))
+            for name in ['make.py', 'duffle.py']:
+                shutil.copy2(
+                    os.path.join(package_dir, name),
+                    os.path.join(staging_dir, name))
+            os.mkdir(os.path.join(staging_dir, 'cnab-drivers'))
+            for name in DRIVER_FILES:
+                shutil.copy2(
+                    os.path.join(self.drivers_path, name),
+                    os.path.join(staging_dir, 'cnab-drivers', name))
+            os.chmod(staging_dir, 0o755)
+
+            _replace_dir(staging_dir, output_dir)
+        except BaseException:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+
+        return cnab_manifest
+
+    async def _image_id(self, spec):
+        """
+        Gets the ID of an image of the bundle.
+
+        Args:
+            spec: The CNAB specification of the image.
+
+        Return:
+            The image ID.
+        """
+        imgref = spec.get('image')
+        if not imgref:
+            raise Exception(f"image {spec} has no 'image' field")
+        if spec.get('contentDigest'):
+            return spec['contentDigest']
+        images = await asyncio.get_running_loop().run_in_executor(
+            None, inspect_images, [imgref])
+        if imgref not in images:
+            raise Exception(f"image {imgref} not found")
+        return images[imgref]['Id']
+
+    async def _export_images(self, imgrefs_by_image_id, output_dir,
+                             staging_dir):
+        """
+        Exports images to a Docker tarball in the "images" folder of the
+        thick bundle being laid out.
+
+        Args:
+            imgrefs_by_image_id: The sets of the references of the images to
+                export, by image ID.
+            output_dir: The folder of the thick bundle, where an existing
+                tarball for the images may be found.
+            staging_dir: The folder where the thick bundle is being laid out.
+
+        Return:
+            The name of the tarball.
+        """
+        images = [(imgref, image_id)
+                  for image_id in sorted(imgrefs_by_image_id)
+                  for imgref in sorted(imgrefs_by_image_id[image_id])]
+        imgrefs = [imgref for imgref, _ in images]
+        key = '\n'.join(f'{imgref}@{image_id}' for imgref, image_id in images)
+        name = hashlib.sha256(key.encode('utf8')).hexdigest()[:32] + '.tar'
+        existing = os.path.join(output_dir, 'images', name)
+        tarball = os.path.join(staging_dir, 'images', name)
+        if os.path.exists(existing):
+            try:
+                os.link(existing, tarball)
+            except OSError:
+                shutil.copy2(existing, tarball)
+            print(f"Reused the export of {len(imgrefs)} images")
+        else:
+            await self.docker.save(imgrefs, tarball)
+            print(f"Exported {len(imgrefs)} images " +
+                  f"({len(imgrefs_by_image_id)} distinct)")
+        return name
+
+
+def _replace_dir(src, dst):
+    """
+    Replaces a folder with another one, by renaming.
+
+    This is not atomic: the folder to replace is first moved aside, so that
+    there is a short window where it does not exist.  It is never seen
+    half-written though.
+
+    Args:
+        src: The new folder.
+        dst: The folder to replace.
+    """
+    if not os.path.exists(dst):
+        os.rename(src, dst)
+        return
+    backup = tempfile.mkdtemp(
+        prefix=f'.{os.path.basename(dst)}.old.', dir=os.path.dirname(dst))
+    os.rmdir(backup)
+    os.rename(dst, backup)
+    try:
+        os.rename(src, dst)
+    except BaseException:
+        os.rename(backup, dst)
+        raise
+    shutil.rmtree(backup, ignore_errors=True)
 
 
 def canonical_json(o):
@@ -233,21 +481,76 @@ class CnabDescriptor:
         """
         Lists all the image references, both of images and invocations images,
         that are given in the CNAB descriptor.
-        :param bundle_path:
-        :return:
+
+        Return:
+            The list of the image references.
+        """
+        images = []
+        for spec in self._list_image_specs():
+            if not spec['image']:
+                raise Exception(f"{spec['name']} has no 'image' field")
+            images += [spec['image']]
+        return images
+
+    def verify(self):
+        """
+        Verifies that all the images, both simple images and invocation
+        images, that are given in the CNAB descriptor are in the Docker
+        daemon, with the expected content digest (image ID), if any.
+
+        All the images are inspected at once.
+
+        Return:
+            The list of the problems found, as strings.
+        """
+        specs = self._list_image_specs()
+        images = inspect_images(
+            sorted(set(spec['image'] for spec in specs if spec['image'])))
+
+        problems = []
+        for spec in specs:
+            if not spec['image']:
+                problems.append(f"{spec['name']}: no 'image' field")
+            elif spec['image'] not in images:
+                problems.append(
+                    f"{spec['name']}: image {spec['image']} not found")
+            elif (spec['contentDigest'] and
+                  images[spec['image']]['Id'] != spec['contentDigest']):
+                problems.append(
+                    f"{spec['name']}: image {spec['image']} has ID " +
+                    f"{images[spec['image']]['Id']}, expected " +
+                    f"{spec['contentDigest']}")
+        return problems
+
+    def _list_image_specs(self):
+        """
+        Lists the specifications of all the images, both simple images and
+        invocation images, that are given in the CNAB descriptor.
+
+        Return:
+            A list of maps with the "name" of the image in the descriptor,
+            its "image" reference and "contentDigest" ("None" if missing).
         """
         with open(self.path, 'r') as f:
             descriptor = json.load(f)
 
-        images = []
+        specs = []
         for image_name in descriptor.get('images', {}):
-            image = descriptor['images'][image_name].get('image', 'image_name')
-            images += [image]
+            image = descriptor['images'][image_name]
+            specs.append({
+                'name': f"images.{image_name}",
+                'image': image.get('image'),
+                'contentDigest': image.get('contentDigest'),
+            })
 
-        for image in descriptor.get('invocationImages', []):
-            images += [image['image']]
+        for i, image in enumerate(descriptor.get('invocationImages', [])):
+            specs.append({
+                'name': f"invocationImages[{i}]",
+                'image': image.get('image'),
+                'contentDigest': image.get('contentDigest'),
+            })
 
-        return images
+        return specs
 
 
 class CLI:
@@ -284,6 +587,38 @@ class CLI:
         args = parser.parse_args(sys.argv[2:])
         DuffleContext(args.path).build_cnab_app(args.output_file)
 
+    def package(self):
+        parser = argparse.ArgumentParser(
+            description='Build a CNAB bundle and package it as a thick bundle')
+        parser.add_argument('path', help='Path to the duffle context')
+        parser.add_argument(
+            '-o',
+            '--output-dir',
+            help='Path to the thick bundle folder',
+            required=True)
+        parser.add_argument(
+            '--drivers-path',
+            help='Path to the folder containing the docker2 driver',
+            default=DEFAULT_DRIVERS_PATH)
+        args = parser.parse_args(sys.argv[2:])
+        ThickBundlePackager(
+            DuffleContext(args.path),
+            drivers_path=args.drivers_path).package(args.output_dir)
+
+    def verify(self):
+        parser = argparse.ArgumentParser(
+            description='Verify that the images of a CNAB bundle are in ' +
+            'the Docker daemon')
+        parser.add_argument(
+            'path', help='Path to the bundle.json file (the CNAB descriptor)')
+        args = parser.parse_args(sys.argv[2:])
+        problems = CnabDescriptor(args.path).verify()
+        for problem in problems:
+            print(problem)
+        if problems:
+            sys.exit(1)
+        print("All the images are in the Docker daemon")
+
 
 if __name__ == "__main__":
     try:
@@ -13,6 +13,33 @@ import hashlib
 import logging
 import tempfile
 import shutil
+import concurrent.futures
+import functools
+import tarfile
+import io
+import asyncio
+import time
+import datetime
+import re
+import contextlib
+
+#: Hash algorithms that can be used to digest the files of build contexts.
+DIGEST_ALGORITHMS = {
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+}
+
+#: Default hash algorithm to digest the files of build contexts.  Digests of
+#: build invocations made with this algorithm do not record it, so that they
+#: stay the same as before the algorithm could be chosen.
+DEFAULT_DIGEST_ALGORITHM = 'sha256'
+
+#: Version of the per-file digests.  To bump whenever the way files are
+#: digested changes, so that digests of build invocations do not collide.
+DIGEST_VERSION = 1
+
+#: Default size of the chunks large files are digested in.
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
 
 
 def content_addressable_imgref(image_repository, image_id):
@@ -28,6 +55,31 @@ def content_addressable_imgref(image_repository, image_id):
     return image_repository + ':' + image_id[image_id.index(':') + 1:][:40]
 
 
+def default_cache_dir():
+    """
+    Returns the folder where cnabtools keeps its local caches: the
+    CNABTOOLS_CACHE_DIR environment variable if set, "~/.cache/cnabtools"
+    otherwise.
+    """
+    return os.environ.get('CNABTOOLS_CACHE_DIR',
+                          os.path.expanduser('~/.cache/cnabtools'))
+
+
+def default_image_store():
+    """
+    Returns the local image store given by the CNABTOOLS_IMAGE_STORE
+    environment variable, with the maximum size given by the
+    CNABTOOLS_IMAGE_STORE_MAX_SIZE environment variable (e.g., "20G"), or
+    "None" if CNABTOOLS_IMAGE_STORE is not set.
+    """
+    path = os.environ.get('CNABTOOLS_IMAGE_STORE')
+    if not path:
+        return None
+    max_size = os.environ.get('CNABTOOLS_IMAGE_STORE_MAX_SIZE')
+    return ImageStore(path,
+                      max_size=_parse_size(max_size) if max_size else None)
+
+
 def _imgref_for_invocation_digest(build_context_digest):
     """
     Returns the image reference to tag an image given the digest of its build
@@ -44,13 +96,564 @@ def _imgref_for_invocation_digest(build_context_digest):
     return 'build-context:' + build_context_digest
 
 
-class Docker:
+class BuildContextDigester:
+    """
+    Digests invocations to "docker build".
+    """
+
+    def __init__(self,
+                 digest_algorithm=DEFAULT_DIGEST_ALGORITHM,
+                 chunk_threshold=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE,
+                 cache_dir=None):
+        """
+        Args:
+            digest_algorithm: The hash algorithm to digest the files of build
+                contexts with (one of the keys of DIGEST_ALGORITHMS).
+            chunk_threshold: If not "None", the files of build contexts whose
+                size is at least this number of bytes are digested chunk by
+                chunk, in parallel, and their digests are cached across
+                invocations (see [[_FileDigestCache]]).
+            chunk_size: The size of the chunks, in bytes.
+            cache_dir: The folder where to keep the local caches (see
+                [[default_cache_dir]]).
+        """
+        if digest_algorithm not in DIGEST_ALGORITHMS:
+            raise Exception(
+                f"unsupported digest algorithm '{digest_algorithm}'")
+        self.digest_algorithm = digest_algorithm
+        self.chunk_threshold = chunk_threshold
+        self.chunk_size = chunk_size
+        self.cache_dir = cache_dir or default_cache_dir()
+
+    def digest_build_invocation(self,
+                                build_context_path,
+                                build_invocation_args=None,
+                                record_manifest=False):
+        """
+        Digests an invocation to "docker build" by digesting the content
+        of the build context and the arguments to pass to "docker build".
+
+        Args:
+            build_context_path: Path to the build context.
+            build_invocation_args: Arguments passed to "docker build".
+            record_manifest: Whether to record the manifest of the build
+                context (see [[manifest_path]]).
+
+        Return:
+            A hex digest.
+        """
+        if not record_manifest:
+            return self._digest_build_invocation(build_context_path,
+                                                 build_invocation_args)
+
+        manifests_dir = os.path.dirname(self.manifest_path(''))
+        os.makedirs(manifests_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=manifests_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                digest = self._digest_build_invocation(
+                    build_context_path, build_invocation_args, f)
+            os.replace(tmp_path, self.manifest_path(digest))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return digest
+
+    def manifest_path(self, build_invocation_digest):
+        """
+        Returns the path to the recorded manifest of the build context for
+        an invocation digest.
+
+        Manifests are JSON lines files.  The first line is a header with the
+        path to the build "context", the "args" to "docker build", the
+        "time" of the recording and the "settings" of the digester.  Each
+        subsequent line is a "[relpath, digest, size]" triple for a file of
+        the build context, in the order of the relative paths.
+        """
+        return os.path.join(self.cache_dir, 'client-cache', 'manifests',
+                            build_invocation_digest + '.jsonl')
+
+    def _digest_build_invocation(self,
+                                 build_context_path,
+                                 build_invocation_args,
+                                 manifest_file=None):
+        """
+        Digests an invocation to "docker build" (see
+        [[digest_build_invocation]]).
+
+        Args:
+            build_context_path: Path to the build context.
+            build_invocation_args: Arguments passed to "docker build".
+            manifest_file: If not "None", the file to write the manifest of
+                the build context to (see [[manifest_path]]).
+
+        Return:
+            A hex digest.
+        """
+
+        # Note that .dockerignore is not taken into account.  This means
+        # that you have potentially more cache misses than if we took
+        # it into account.
+
+        file_digest_cache = None
+        if self.chunk_threshold is not None:
+            file_digest_cache = _FileDigestCache(
+                os.path.join(self.cache_dir, 'file-digests.json'))
+
+        payload = {
+            'args': build_invocation_args,
+        }
+        if (self.digest_algorithm != DEFAULT_DIGEST_ALGORITHM or
+                self.chunk_threshold is not None):
+            payload['digestAlgorithm'] = self.digest_algorithm
+            payload['digestVersion'] = DIGEST_VERSION
+        if self.chunk_threshold is not None:
+            payload['chunkThreshold'] = self.chunk_threshold
+            payload['chunkSize'] = self.chunk_size
+
+        if manifest_file:
+            manifest_file.write(
+                json.dumps({
+                    'context': os.path.abspath(build_context_path),
+                    'args': build_invocation_args,
+                    'time': time.time(),
+                    'settings': {
+                        k: v for k, v in payload.items() if k != 'args'
+                    },
+                }) + '\n')
+
+        def digests():
+            for relpath, path in _walk_build_context(build_context_path):
+                digest = self._digest_context_file(path, file_digest_cache)
+                if manifest_file:
+                    manifest_file.write(
+                        json.dumps([relpath, digest,
+                                    os.path.getsize(path)]) + '\n')
+                yield relpath, digest
+
+        digest = _digest_json_streaming(payload, 'digests', digests())
+
+        if file_digest_cache:
+            file_digest_cache.save()
+
+        return digest
+
+    def _digest_context_file(self, path, file_digest_cache):
+        """
+        Digests a file of a build context.
+
+        Args:
+            path: The path to the file.
+            file_digest_cache: The cache for the digests of large files, or
+                "None" if large files are not digested chunk by chunk.
+
+        Return:
+            A hex digest (a string).
+        """
+        if not file_digest_cache:
+            return _digest_file(path, self.digest_algorithm)
+        stat = os.stat(path)
+        if stat.st_size < self.chunk_threshold:
+            return _digest_file(path, self.digest_algorithm)
+        entry = file_digest_cache.get(path, stat, self.digest_algorithm,
+                                      self.chunk_size)
+        if not entry:
+            chunks = _digest_file_chunks(path, stat.st_size,
+                                         self.digest_algorithm,
+                                         self.chunk_size)
+            entry = file_digest_cache.put(
+                path, stat, self.digest_algorithm, self.chunk_size,
+                _digest_chunk_list(chunks, self.digest_algorithm))
+        return entry['digest']
+
+
+#: Value of the "output" argument of [[AsyncDocker._run]] to capture the
+#: standard output.
+_CAPTURE = object()
+
+
+class AsyncDocker:
+    """
+    Asynchronous counterpart of [[Docker]], based on asyncio subprocesses.
+
+    Cancelling an operation kills the Docker CLI processes it started.
+    """
+
+    def __init__(self,
+                 logger_name="docker",
+                 max_concurrency=None,
+                 build_log=None,
+                 image_store=None,
+                 **kwargs):
+        """
+        Args:
+            logger_name: The name of the logger to use.
+            max_concurrency: If not "None", the maximum number of Docker CLI
+                processes to run at the same time.
+            build_log: If not "None", a callable that is given, line by line,
+                the output of "docker build" as it is produced.  Otherwise,
+                the output of "docker build" is not captured.
+            image_store: If not "None", the ImageStore to save built images
+                to, and to restore images from when they are missing from the
+                Docker daemon.  Failures of the store are only logged.
+            **kwargs: Additional arguments to pass to
+                [[BuildContextDigester]].
+        """
+        self.digester = BuildContextDigester(**kwargs)
+        self.max_concurrency = max_concurrency
+        self.build_log = build_log
+        self.image_store = image_store
 
-    def __init__(self, logger_name="docker"):
         self.env = {**os.environ, "DOCKER_BUILDKIT": "1"}
 
         self.logger = logging.getLogger(logger_name)
 
+        self._semaphore = None
+        self._semaphore_loop = None
+        self._builds = None
+        self._builds_loop = None
+
+    async def build_content_addressable(self, build_context_path,
+                                        image_repository, **kwargs):
+        """
+        See [[Docker.build_content_addressable]].
+        """
+        image_id = await self.build_with_client_cache(build_context_path,
+                                                      **kwargs)
+        imgref = await self.tag_content_addressable(image_repository,
+                                                    image_id)
+        return imgref, image_id
+
+    async def tag_content_addressable(self, image_repository, image_id):
+        """
+        See [[Docker.tag_content_addressable]].
+        """
+        imgref = content_addressable_imgref(image_repository, image_id)
+        await self._run([
+            'docker',
+            'tag',
+            image_id,
+            imgref,
+        ],
+                        buildkit=False)
+        return imgref
+
+    async def build_with_client_cache(self,
+                                      build_context_path,
+                                      iidfile=None,
+                                      args=None):
+        """
+        See [[Docker.build_with_client_cache]].
+
+        Concurrent calls for the same invocation digest share a single
+        build: the first one misses the client cache and builds, the others
+        wait for it instead of uploading the same build context again.
+        """
+        if not args:
+            args = []
+
+        build_invocation_digest = await self.digest_build_invocation(
+            build_context_path, args)
+
+        builds = self._in_flight_builds()
+        build = builds.get(build_invocation_digest)
+        if not build:
+            build = _InFlightBuild(
+                asyncio.ensure_future(
+                    self._build_with_client_cache(build_context_path, args,
+                                                  build_invocation_digest)))
+            builds[build_invocation_digest] = build
+
+            def forget(task):
+                if builds.get(build_invocation_digest) is build:
+                    del builds[build_invocation_digest]
+
+            build.task.add_done_callback(forget)
+        build.waiters += 1
+        try:
+            image_id = await asyncio.shield(build.task)
+        finally:
+            build.waiters -= 1
+            # Cancel the build once nobody waits for it anymore.
+            if build.waiters == 0 and not build.task.done():
+                build.task.cancel()
+
+        if iidfile:
+            with open(iidfile, 'w') as f:
+                f.write(image_id)
+        return image_id
+
+    async def _build_with_client_cache(self, build_context_path, args,
+                                       build_invocation_digest):
+        """
+        Builds an image for an invocation digest, unless it is in the client
+        cache (see [[build_with_client_cache]]).
+
+        The manifest of the build context is only recorded if there is none
+        for the invocation digest yet, concurrently with the build.
+        Otherwise, its modification time is updated, which marks it as
+        recently used (see [[CacheMissExplainer]]).
+
+        Return:
+            The image ID.
+        """
+        manifest_path = self.digester.manifest_path(build_invocation_digest)
+        record = None
+        try:
+            os.utime(manifest_path)
+        except FileNotFoundError:
+            record = asyncio.ensure_future(
+                self.digest_build_invocation(build_context_path,
+                                             args,
+                                             record_manifest=True))
+        try:
+            image_id = await self._lookup_or_build(build_context_path, args,
+                                                   build_invocation_digest)
+        except BaseException:
+            if record:
+                record.cancel()
+            raise
+        if record:
+            # The manifest is only used to explain cache misses.
+            try:
+                await record
+            except Exception as e:
+                self.logger.warning(
+                    f"cannot record the manifest of {build_context_path}: {e}")
+        return image_id
+
+    async def _lookup_or_build(self, build_context_path, args,
+                               build_invocation_digest):
+        """
+        Looks an image up in the client cache and the image store, and builds
+        it if it is in neither.
+
+        Return:
+            The image ID.
+        """
+        imgref = _imgref_for_invocation_digest(build_invocation_digest)
+        image_id = await self.image_id(imgref)
+        if not image_id and self.image_store:
+            # The image store is best-effort: the image is built if it cannot
+            # be restored.
+            try:
+                if await asyncio.get_running_loop().run_in_executor(
+                        None, self.image_store.restore,
+                        build_invocation_digest):
+                    image_id = await self.image_id(imgref)
+            except Exception as e:
+                self.logger.warning(
+                    f"cannot restore {imgref} from the image store: {e}")
+        if image_id:
+            _record_client_cache_hit(self.digester.cache_dir,
+                                     build_invocation_digest)
+            return image_id
+
+        tmpdir = tempfile.mkdtemp()
+        iidfile = os.path.join(tmpdir, 'iidfile')
+        try:
+            await self._run(
+                ['docker', 'build', '--iidfile', iidfile] + args +
+                [build_context_path],
+                check=True,
+                output=self.build_log)
+            with open(iidfile, 'r') as f:
+                iid = f.read().strip()
+            await self._run(['docker', 'tag', iid, imgref], check=True)
+            _record_client_cache_hit(self.digester.cache_dir,
+                                     build_invocation_digest)
+            if self.image_store:
+                try:
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, self.image_store.put, build_invocation_digest,
+                        iid)
+                except Exception as e:
+                    self.logger.warning(
+                        f"cannot save {imgref} to the image store: {e}")
+        finally:
+            shutil.rmtree(tmpdir)
+
+        return iid
+
+    async def save(self, imgrefs, output_tarball_path):
+        """
+        See [[Docker.save]].
+        """
+        await self._run(
+            ['docker', 'save', '--output', output_tarball_path] + imgrefs,
+            check=True,
+            buildkit=False)
+
+    async def digest_build_invocation(self,
+                                      build_context_path,
+                                      build_invocation_args=None,
+                                      record_manifest=False):
+        """
+        See [[BuildContextDigester.digest_build_invocation]].
+
+        The digest is computed in the default executor of the event loop.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            None,
+            functools.partial(
+                self.digester.digest_build_invocation,
+                build_context_path,
+                build_invocation_args,
+                record_manifest=record_manifest))
+
+    async def image_id(self, imgref):
+        """
+        See [[Docker.image_id]].
+        """
+        returncode, stdout = await self._run(
+            ['docker', 'inspect', imgref, '--format', '{{ .Id }}'],
+            output=_CAPTURE)
+        if returncode != 0:
+            return None
+        else:
+            return stdout.strip()
+
+    async def _run(self, args, check=False, output=None, buildkit=True):
+        """
+        Runs a Docker CLI command.
+
+        Args:
+            args: The command line.
+            check: Whether to raise a "subprocess.CalledProcessError" if the
+                command fails.
+            output: What to do with the standard output and error of the
+                command: "None" to not capture them, _CAPTURE to capture the
+                standard output (the standard error is discarded), or a
+                callable to give them to line by line.
+            buildkit: Whether to run the command with DOCKER_BUILDKIT=1 or
+                with the environment of the current process.
+
+        Return:
+            The return code, and the captured standard output as a string
+            (or "None" if it was not captured).
+        """
+        kwargs = {}
+        if output is _CAPTURE:
+            kwargs = {
+                'stdout': asyncio.subprocess.PIPE,
+                'stderr': asyncio.subprocess.DEVNULL
+            }
+        elif output:
+            kwargs = {
+                'stdout': asyncio.subprocess.PIPE,
+                'stderr': asyncio.subprocess.STDOUT
+            }
+        async with self._limit():
+            proc = await asyncio.create_subprocess_exec(
+                *args, env=self.env if buildkit else None, **kwargs)
+            try:
+                stdout = None
+                if output is _CAPTURE:
+                    stdout = (await proc.stdout.read()).decode('utf8')
+                elif output:
+                    async for line in proc.stdout:
+                        output(line.decode('utf8', errors='replace').rstrip(
+                            '\r\n'))
+                returncode = await proc.wait()
+            except BaseException:
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                raise
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, args)
+        return returncode, stdout
+
+    def _in_flight_builds(self):
+        """
+        Returns the builds in progress in the running event loop, by
+        invocation digest.
+        """
+        loop = asyncio.get_running_loop()
+        if self._builds_loop is not loop:
+            self._builds = {}
+            self._builds_loop = loop
+        return self._builds
+
+    def _limit(self):
+        """
+        Returns an async context manager that limits the number of Docker CLI
+        processes running at the same time.
+        """
+        if self.max_concurrency is None:
+            return _NoLimit()
+        loop = asyncio.get_running_loop()
+        if self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+
+class _InFlightBuild:
+    """
+    A build in progress, shared by the calls to
+    [[AsyncDocker.build_with_client_cache]] for the same invocation digest.
+    """
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class _NoLimit:
+
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+async def gather_or_cancel(*aws):
+    """
+    Like "asyncio.gather", except that when an awaitable fails, the other
+    ones are cancelled (and awaited) before the error is raised.
+
+    Args:
+        *aws: The awaitables.
+
+    Return:
+        The list of the results.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+class Docker:
+    """
+    Synchronous interface to Docker/Buildkit.  This is a thin wrapper around
+    [[AsyncDocker]].
+
+    Each call runs an event loop of its own, with "asyncio.run".  Hence, the
+    methods cannot be called from a running event loop (use AsyncDocker
+    there), and, before Python 3.8, they can only be called from the main
+    thread, as asyncio subprocesses are not supported in other threads.
+    """
+
+    def __init__(self, logger_name="docker", **kwargs):
+        """
+        Args:
+            logger_name: The name of the logger to use.
+            **kwargs: Additional arguments to pass to [[AsyncDocker]].
+        """
+        self.async_docker = AsyncDocker(logger_name=logger_name, **kwargs)
+
+        self.env = self.async_docker.env
+
+        self.logger = self.async_docker.logger
+
     def build_content_addressable(self, build_context_path, image_repository,
                                   **kwargs):
         """
@@ -73,9 +676,9 @@ class Docker:
             The image reference, i.e. "repository:image_id", where
             image ID is the ID of the image as given by `docker build`.
         """
-        image_id = self.build_with_client_cache(build_context_path, **kwargs)
-        imgref = self.tag_content_addressable(image_repository, image_id)
-        return imgref, image_id
+        return asyncio.run(
+            self.async_docker.build_content_addressable(
+                build_context_path, image_repository, **kwargs))
 
     def tag_content_addressable(self, image_repository, image_id):
         """
@@ -88,14 +691,9 @@ class Docker:
         Returns:
             The image reference, i.e. "repository:image_id".
         """
-        imgref = content_addressable_imgref(image_repository, image_id)
-        subprocess.run([
-            'docker',
-            'tag',
-            image_id,
-            imgref,
-        ])
-        return imgref
+        return asyncio.run(
+            self.async_docker.tag_content_addressable(image_repository,
+                                                      image_id))
 
     def build_with_client_cache(self,
                                 build_context_path,
@@ -122,40 +720,19 @@ class Docker:
         Return:
             The image ID.
         """
-        if not args:
-            args = []
+        return asyncio.run(
+            self.async_docker.build_with_client_cache(build_context_path,
+                                                      iidfile, args))
 
-        build_invocation_digest = self.digest_build_invocation(
-            build_context_path, args)
-        imgref = _imgref_for_invocation_digest(build_invocation_digest)
-        image_id = self.image_id(imgref)
-        if image_id:
-            if iidfile:
-                with open(iidfile, 'w') as f:
-                    f.write(image_id)
-            return image_id
-
-        tmpdir = None
-        if not iidfile:
-            tmpdir = tempfile.mkdtemp()
-            iidfile = os.path.join(tmpdir, 'iidfile')
-
-        try:
-            subprocess.run(
-                ['docker', 'build', '--iidfile', iidfile] + args +
-                [build_context_path],
-                env=self.env,
-                check=True)
-            with open(iidfile, 'r') as f:
-                iid = f.read().strip()
-            subprocess.run(['docker', 'tag', iid, imgref],
-                           env=self.env,
-                           check=True)
-        finally:
-            if tmpdir:
-                shutil.rmtree(tmpdir)
+    def save(self, imgrefs, output_tarball_path):
+        """
+        Saves images to a Docker tarball, using "docker save".
 
-        return iid
+        Args:
+            imgrefs: The references of the images to save.
+            output_tarball_path: Path to the output tarball.
+        """
+        asyncio.run(self.async_docker.save(imgrefs, output_tarball_path))
 
     def digest_build_invocation(self,
                                 build_context_path,
@@ -171,22 +748,8 @@ class Docker:
         Return:
             A hex digest.
         """
-
-        # Note that .dockerignore is not taken into account.  This means
-        # that you have potentially more cache misses than if we took
-        # it into account.
-
-        digests = {}
-        for dp, dn, filenames in os.walk(build_context_path):
-            for f in filenames:
-                path = os.path.join(dp, f)
-                digests[os.path.relpath(path,
-                                        build_context_path)] =\
-                    _digest_file(path)
-        return _digest_json({
-            'digests': digests,
-            'args': build_invocation_args,
-        })
+        return self.async_docker.digester.digest_build_invocation(
+            build_context_path, build_invocation_args)
 
     def image_id(self, imgref):
         """
@@ -199,30 +762,883 @@ class Docker:
             The image ID, or "None" if the image could not be found in the
             buildkit cache.
         """
+        return asyncio.run(self.async_docker.image_id(imgref))
+
+
+def _client_cache_hits_dir(cache_dir):
+    """
+    Returns the folder where the last hits of the client cache are recorded:
+    the modification time of the file named after an invocation digest is
+    the last time the image for the digest was built or used.
+    """
+    return os.path.join(cache_dir, 'client-cache', 'hits')
+
+
+def _record_client_cache_hit(cache_dir, build_invocation_digest):
+    """
+    Records a hit of the client cache (see [[_client_cache_hits_dir]]).
+    """
+    hits_dir = _client_cache_hits_dir(cache_dir)
+    os.makedirs(hits_dir, exist_ok=True)
+    path = os.path.join(hits_dir, build_invocation_digest)
+    open(path, 'a').close()
+    os.utime(path)
+
+
+class ClientCacheGC:
+    """
+    Garbage-collects the images of the client cache, i.e., the
+    "build-context:<digest>" tags (see [[Docker.build_with_client_cache]]),
+    along with the content-addressable tags of the images they point to
+    (see [[Docker.tag_content_addressable]]).
+    """
+
+    def __init__(self, cache_dir=None):
+        """
+        Args:
+            cache_dir: The folder where the local caches are kept (see
+                [[default_cache_dir]]).
+        """
+        self.cache_dir = cache_dir or default_cache_dir()
+
+    def collect(self,
+                max_age=None,
+                max_count=None,
+                max_size=None,
+                keep_bundles=None,
+                keep_bundles_max_age=None,
+                dry_run=False):
+        """
+        Removes the least recently used entries of the client cache, until
+        the budgets are met.
+
+        Args:
+            max_age: If not "None", entries not used for that many seconds
+                are removed, along with the hits and manifests of the
+                invocation digests that are not tagged anymore and that are
+                older than that (see [[_orphaned_paths]]).
+            max_count: If not "None", the maximum number of entries to keep.
+            max_size: If not "None", the maximum total size, in bytes, of
+                the images to keep.  Layers shared between images are
+                counted once per image, so this is an upper bound.
+            keep_bundles: Paths to "bundle.json" files, or to folders to
+                search for "bundle.json" files.  The images these bundles
+                reference are never removed (but count towards the budgets).
+            keep_bundles_max_age: If not "None", only the bundles modified
+                within that many seconds are taken into account.
+            dry_run: Only report what would be removed.
+
+        Return:
+            The list of the image references that were (or would be) removed.
+            The references that "docker image rm" failed to remove are left
+            out, and the state of their entries is kept.
+        """
+        now = time.time()
+        entries = self._list_entries()
+        images = inspect_images(sorted(set(e['id'] for e in entries)))
+        kept_ids = self._referenced_image_ids(keep_bundles or [],
+                                              keep_bundles_max_age, images)
+
+        hits_dir = _client_cache_hits_dir(self.cache_dir)
+        for e in entries:
+            try:
+                e['lastHit'] = os.path.getmtime(
+                    os.path.join(hits_dir, e['digest']))
+            except OSError:
+                created = images.get(e['id'], {}).get('Created')
+                e['lastHit'] = _parse_docker_timestamp(created) if created \
+                    else 0
+        entries.sort(key=lambda e: e['lastHit'], reverse=True)
+
+        kept_entries = []
+        evicted_entries = []
+        kept_size_ids = set()
+        kept_size = 0
+        for e in entries:
+            size = 0
+            if e['id'] not in kept_size_ids:
+                size = images.get(e['id'], {}).get('Size', 0)
+            if e['id'] not in kept_ids and (
+                (max_age is not None and now - e['lastHit'] > max_age) or
+                (max_count is not None and len(kept_entries) >= max_count) or
+                (max_size is not None and kept_size + size > max_size)):
+                evicted_entries.append(e)
+            else:
+                kept_entries.append(e)
+                kept_size_ids.add(e['id'])
+                kept_size += size
+
+        refs = [
+            _imgref_for_invocation_digest(e['digest']) for e in evicted_entries
+        ]
+        still_cached_ids = set(e['id'] for e in kept_entries) | kept_ids
+        for image_id in sorted(set(e['id'] for e in evicted_entries)):
+            if image_id in still_cached_ids:
+                continue
+            for tag in images.get(image_id, {}).get('RepoTags') or []:
+                repository = tag[:tag.rindex(':')]
+                if tag == content_addressable_imgref(repository, image_id):
+                    refs.append(tag)
+
+        orphaned_paths = []
+        if max_age is not None:
+            orphaned_paths = self._orphaned_paths(
+                set(e['digest'] for e in entries), now - max_age)
+
+        print(f"{len(kept_entries)} cache entries kept " +
+              f"({kept_size} bytes), {len(evicted_entries)} evicted, " +
+              f"{len(orphaned_paths)} orphaned files")
+        for ref in refs:
+            print(f"    {ref}")
+        if dry_run:
+            return refs
+
+        for batch in _batches(refs):
+            subprocess.run(['docker', 'image', 'rm'] + batch)
+        # Some images may not have been removed, e.g., because containers
+        # use them: keep the state of their entries.
+        remaining = inspect_images(refs)
+        refs = [ref for ref in refs if ref not in remaining]
+        digester = BuildContextDigester(cache_dir=self.cache_dir)
+        paths = list(orphaned_paths)
+        for e in evicted_entries:
+            if _imgref_for_invocation_digest(e['digest']) in remaining:
+                continue
+            paths += [
+                os.path.join(hits_dir, e['digest']),
+                digester.manifest_path(e['digest'])
+            ]
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return refs
+
+    def _orphaned_paths(self, digests, older_than):
+        """
+        Lists the client cache hits and build context manifests of the
+        invocation digests that are not tagged anymore, e.g., because the
+        images were removed outside of the garbage collector.
+
+        Args:
+            digests: The invocation digests of the entries of the client
+                cache.
+            older_than: Only the files modified before that POSIX timestamp
+                are listed, so that the files of builds in progress are
+                kept.
+
+        Return:
+            A list of paths.
+        """
+        hits_dir = _client_cache_hits_dir(self.cache_dir)
+        manifests_dir = os.path.dirname(
+            BuildContextDigester(cache_dir=self.cache_dir).manifest_path(''))
+        paths = []
+        for directory, suffix in [(hits_dir, ''), (manifests_dir, '.jsonl')]:
+            try:
+                filenames = os.listdir(directory)
+            except OSError:
+                continue
+            for filename in filenames:
+                if not filename.endswith(suffix):
+                    continue
+                digest = filename[:len(filename) - len(suffix)]
+                path = os.path.join(directory, filename)
+                try:
+                    if (digest not in digests and
+                            os.path.getmtime(path) < older_than):
+                        paths.append(path)
+                except OSError:
+                    pass
+        return sorted(paths)
+
+    def _list_entries(self):
+        """
+        Lists the entries of the client cache.
+
+        Return:
+            A list of maps with the invocation "digest" and image "id" of
+            the entries.
+        """
+        p = subprocess.run([
+            'docker', 'image', 'ls', '--no-trunc', '--format',
+            '{{.Tag}}\t{{.ID}}', 'build-context'
+        ],
+                           capture_output=True,
+                           encoding='utf8',
+                           check=True)
+        entries = []
+        for line in p.stdout.splitlines():
+            digest, image_id = line.split('\t')
+            entries.append({'digest': digest, 'id': image_id})
+        return entries
+
+    def _referenced_image_ids(self, keep_bundles, keep_bundles_max_age,
+                              images):
+        """
+        Returns the IDs of the images referenced by bundles.
+
+        Args:
+            keep_bundles: See [[collect]].
+            keep_bundles_max_age: See [[collect]].
+            images: The inspected images of the client cache, by ID.
+
+        Return:
+            A set of image IDs.
+        """
+        bundle_paths = []
+        for path in keep_bundles:
+            if os.path.isdir(path):
+                for dp, dn, filenames in os.walk(path):
+                    if 'bundle.json' in filenames:
+                        bundle_paths.append(os.path.join(dp, 'bundle.json'))
+            else:
+                bundle_paths.append(path)
+
+        ids_by_tag = {}
+        for image_id, image in images.items():
+            for tag in image.get('RepoTags') or []:
+                ids_by_tag[tag] = image_id
+
+        now = time.time()
+        ids = set()
+        for bundle_path in bundle_paths:
+            if (keep_bundles_max_age is not None and
+                    now - os.path.getmtime(bundle_path) > keep_bundles_max_age):
+                continue
+            with open(bundle_path, 'r') as f:
+                descriptor = json.load(f)
+            specs = list(descriptor.get('images', {}).values()) + list(
+                descriptor.get('invocationImages', []))
+            for spec in specs:
+                if spec.get('contentDigest'):
+                    ids.add(spec['contentDigest'])
+                if spec.get('image') in ids_by_tag:
+                    ids.add(ids_by_tag[spec['image']])
+        return ids
+
+
+class ImageStore:
+    """
+    Local, on-disk, content-addressed store of images, keyed by build
+    invocation digest.
+
+    This allows the client cache (see [[Docker.build_with_client_cache]]) to
+    survive Docker daemons that are thrown away, e.g., Docker-in-Docker
+    daemons in CI, as long as the store is on a persistent volume.
+
+    The store has the following layout:
+
+        blobs/sha256/<hex>: Image configs and layers, as found in the output
+            of "docker save", addressed by the SHA-256 of their content.
+        images/<invocation digest>.json: The "config" and "layers" blobs of
+            the image for an invocation digest.  The modification time of
+            the file is the last time the image was saved or restored.
+    """
+
+    #: Blobs more recent than that, in seconds, are never garbage-collected,
+    #: as they may belong to an image that is being saved concurrently.
+    BLOB_GRACE_PERIOD = 600
+
+    def __init__(self, path, max_size=None):
+        """
+        Args:
+            path: The path to the store.
+            max_size: If not "None", the maximum size, in bytes, of the
+                store.  The least recently used images are evicted to stay
+                below it.
+        """
+        self.path = path
+        self.max_size = max_size
+
+    def put(self, build_invocation_digest, image_id):
+        """
+        Saves an image to the store.
+
+        Args:
+            build_invocation_digest: The invocation digest the image was built
+                for.
+            image_id: The ID of the image.
+        """
+        if os.path.exists(self._index_path(build_invocation_digest)):
+            os.utime(self._index_path(build_invocation_digest))
+            return
+
+        tmp_dir = os.path.join(self.path, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        os.makedirs(self._blob_path(''), exist_ok=True)
+
+        blobs = {}
+        links = {}
+        manifest = None
+        p = subprocess.Popen(['docker', 'save', image_id],
+                             stdout=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=p.stdout, mode='r|') as tar:
+                for member in tar:
+                    if member.issym():
+                        links[member.name] = os.path.normpath(
+                            os.path.join(
+                                os.path.dirname(member.name),
+                                member.linkname)).replace(os.sep, '/')
+                    elif member.islnk():
+                        links[member.name] = member.linkname
+                    elif member.isfile():
+                        f = tar.extractfile(member)
+                        if member.name == 'manifest.json':
+                            manifest = json.loads(f.read())
+                        else:
+                            blobs[member.name] = self._write_blob(f, tmp_dir)
+        finally:
+            p.stdout.close()
+            returncode = p.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, p.args)
+        if not manifest or len(manifest) != 1:
+            raise Exception(
+                f"unexpected 'docker save' manifest for image {image_id}")
+
+        def blob(name):
+            name = links.get(name, name)
+            return blobs[name]
+
+        index = {
+            'config': blob(manifest[0]['Config']),
+            'layers': [blob(layer) for layer in manifest[0]['Layers']],
+        }
+        os.makedirs(os.path.dirname(self._index_path('')), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self._index_path(build_invocation_digest))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if self.max_size is not None:
+            self.evict(self.max_size, keep=[build_invocation_digest])
+
+    def restore(self, build_invocation_digest):
+        """
+        Restores an image from the store into the Docker daemon, tagged with
+        the image reference for its invocation digest (see
+        [[_imgref_for_invocation_digest]]).
+
+        Only the layers that the daemon does not already have are loaded.
+        This relies on "docker load" not reading these layers, as with the
+        classic graph drivers: if the partial load fails (e.g., with the
+        containerd image store), the image is loaded again with all its
+        layers.
+
+        Args:
+            build_invocation_digest: The invocation digest to restore the image
+                of.
+
+        Return:
+            "True" if the image was restored, "False" if it is not in the
+            store.
+        """
+        index_path = self._index_path(build_invocation_digest)
+        try:
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if not all(
+                os.path.exists(self._blob_path(blob))
+                for blob in [index['config']] + index['layers']):
+            os.remove(index_path)
+            return False
+        os.utime(index_path)
+
+        with open(self._blob_path(index['config']), 'r') as f:
+            diff_ids = json.load(f)['rootfs']['diff_ids']
+        local_chain_ids = set(_chain_ids(diff_ids)) & self._local_chain_ids()
+        if local_chain_ids and self._load(build_invocation_digest, index,
+                                          diff_ids, local_chain_ids,
+                                          subprocess.DEVNULL) == 0:
+            return True
+        returncode = self._load(build_invocation_digest, index, diff_ids,
+                                set(), None)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, ['docker', 'load'])
+        return True
+
+    def _load(self, build_invocation_digest, index, diff_ids, skipped_chain_ids,
+              stderr):
+        """
+        Loads an image of the store into the Docker daemon with "docker load".
+
+        Args:
+            build_invocation_digest: The invocation digest of the image.
+            index: The index of the image (see [[_index_path]]).
+            diff_ids: The diff IDs of the layers of the image.
+            skipped_chain_ids: The chain IDs of the layers to leave out of the
+                tarball given to "docker load".
+            stderr: Where to send the standard error of "docker load" (see
+                [[subprocess.Popen]]).
+
+        Return:
+            The return code of "docker load".
+        """
+        p = subprocess.Popen(['docker', 'load'],
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.DEVNULL,
+                             stderr=stderr)
+        try:
+            with tarfile.open(fileobj=p.stdin, mode='w|') as tar:
+                layer_names = [
+                    f'{i}/layer.tar' for i in range(len(index['layers']))
+                ]
+                manifest = json.dumps([{
+                    'Config': 'config.json',
+                    'RepoTags': [
+                        _imgref_for_invocation_digest(build_invocation_digest)
+                    ],
+                    'Layers': layer_names,
+                }]).encode('utf8')
+                info = tarfile.TarInfo('manifest.json')
+                info.size = len(manifest)
+                tar.addfile(info, io.BytesIO(manifest))
+                tar.add(self._blob_path(index['config']), arcname='config.json')
+                for layer, layer_name, chain_id in zip(index['layers'],
+                                                       layer_names,
+                                                       _chain_ids(diff_ids)):
+                    if chain_id not in skipped_chain_ids:
+                        tar.add(self._blob_path(layer), arcname=layer_name)
+        except BrokenPipeError:
+            # "docker load" failed early: its return code tells.
+            pass
+        finally:
+            try:
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = p.wait()
+        return returncode
+
+    def evict(self, max_size, keep=None):
+        """
+        Evicts the least recently used images until the store is below a
+        given size, and removes the blobs no image refers to anymore.
+
+        Args:
+            max_size: The maximum size of the store, in bytes.
+            keep: Invocation digests of images never to evict.
+        """
+        keep = set(keep or [])
+        images_dir = os.path.dirname(self._index_path(''))
+        indexes = []
+        for name in os.listdir(images_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(images_dir, name)
+            try:
+                with open(path, 'r') as f:
+                    index = json.load(f)
+                indexes.append((os.path.getmtime(path), name[:-len('.json')],
+                                index))
+            except (OSError, ValueError):
+                continue
+        indexes.sort(key=lambda i: i[0])
+
+        def referenced_blobs():
+            return set(blob for _, _, index in indexes
+                       for blob in [index['config']] + index['layers'])
+
+        sizes = {}
+        for blob in referenced_blobs():
+            try:
+                sizes[blob] = os.path.getsize(self._blob_path(blob))
+            except OSError:
+                sizes[blob] = 0
+        blobs = referenced_blobs()
+        for entry in list(indexes):
+            if sum(sizes[blob] for blob in blobs) <= max_size:
+                break
+            digest = entry[1]
+            if digest in keep:
+                continue
+            os.remove(self._index_path(digest))
+            indexes.remove(entry)
+            blobs = referenced_blobs()
+
+        now = time.time()
+        for name in os.listdir(self._blob_path('')):
+            path = self._blob_path(name)
+            if name not in blobs and \
+                    now - os.path.getmtime(path) > self.BLOB_GRACE_PERIOD:
+                os.remove(path)
+
+    def _local_chain_ids(self):
+        """
+        Returns the chain IDs of all the layers the Docker daemon has.
+        """
         p = subprocess.run(
-            ['docker', 'inspect', imgref, '--format', '{{ .Id }}'],
+            ['docker', 'image', 'ls', '--all', '--quiet', '--no-trunc'],
             capture_output=True,
             encoding='utf8',
-            env=self.env)
-        if p.returncode != 0:
-            return None
+            check=True)
+        images = inspect_images(sorted(set(p.stdout.split())))
+        chain_ids = set()
+        for image in images.values():
+            chain_ids.update(_chain_ids(image['RootFS'].get('Layers') or []))
+        return chain_ids
+
+    def _write_blob(self, f, tmp_dir):
+        """
+        Writes a blob to the store.
+
+        Args:
+            f: A file object to read the blob from.
+            tmp_dir: The folder where to put the blob while it is written.
+
+        Return:
+            The hex digest of the blob.
+        """
+        BUF_SIZE = 1024 * 1024
+
+        m = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    buf = f.read(BUF_SIZE)
+                    if not buf:
+                        break
+                    m.update(buf)
+                    out.write(buf)
+            blob = m.hexdigest()
+            if os.path.exists(self._blob_path(blob)):
+                os.remove(tmp_path)
+                os.utime(self._blob_path(blob))
+            else:
+                os.replace(tmp_path, self._blob_path(blob))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return blob
+
+    def _blob_path(self, blob):
+        return os.path.join(self.path, 'blobs', 'sha256', blob)
+
+    def _index_path(self, build_invocation_digest):
+        return os.path.join(self.path, 'images',
+                            build_invocation_digest + '.json')
+
+
+def _chain_ids(diff_ids):
+    """
+    Computes the chain IDs of the layers of an image, as the Docker daemon
+    identifies them.
+
+    Args:
+        diff_ids: The diff IDs of the layers ("sha256:<hex>").
+
+    Return:
+        The list of the chain IDs.
+    """
+    chain_ids = []
+    for diff_id in diff_ids:
+        if chain_ids:
+            chain_ids.append('sha256:' + hashlib.sha256(
+                (chain_ids[-1] + ' ' + diff_id).encode('utf8')).hexdigest())
         else:
-            return p.stdout.strip()
+            chain_ids.append(diff_id)
+    return chain_ids
 
 
-def _digest_file(file):
+class CacheMissExplainer:
+    """
+    Explains why a build context misses the client cache, by diffing its
+    manifest against the nearest manifest recorded by
+    [[Docker.build_with_client_cache]].
+    """
+
+    #: Maximum number of recorded manifests to diff against.
+    MAX_CANDIDATES = 5
+
+    def __init__(self, digester):
+        """
+        Args:
+            digester: The BuildContextDigester that was used to build (it
+                gives, in particular, the location of the recorded manifests).
+        """
+        self.digester = digester
+
+    def explain(self, build_context_path, build_invocation_args=None):
+        """
+        Diffs a build context against the nearest recorded manifest.
+
+        The candidates are the most recently used manifests for the same
+        build context path (or, if there are none, for any path).  The
+        nearest one is the one with the fewest changed bytes.
+
+        Args:
+            build_context_path: Path to the build context.
+            build_invocation_args: Arguments passed to "docker build".
+
+        Return:
+            A map with the "digest" of the invocation, whether it is
+            "recorded", and, if it is not recorded and a previous manifest
+            could be found, the "previous" digest, the "previousHeader",
+            the "added", "removed" and "modified" files as lists of
+            "(relpath, bytes)" pairs ranked by bytes, the "changedBytes",
+            and the "args" and "settings" as "(previous, current)" pairs
+            if they differ.
+        """
+        with tempfile.TemporaryFile('w+') as f:
+            digest = self.digester._digest_build_invocation(
+                build_context_path, build_invocation_args, f)
+            f.seek(0)
+            header, files = _read_manifest(f)
+
+        if os.path.exists(self.digester.manifest_path(digest)):
+            return {'digest': digest, 'recorded': True}
+
+        report = {'digest': digest, 'recorded': False}
+        nearest = None
+        for candidate in self._candidates(header['context']):
+            with open(self.digester.manifest_path(candidate), 'r') as f:
+                previous_header, previous_files = _read_manifest(f)
+            diff = _diff_manifests(previous_files, files)
+            if not nearest or diff['changedBytes'] < nearest['changedBytes']:
+                nearest = {
+                    'previous': candidate,
+                    'previousHeader': previous_header,
+                    **diff,
+                }
+        if not nearest:
+            return report
+        report.update(nearest)
+        for key in ['args', 'settings']:
+            if nearest['previousHeader'][key] != header[key]:
+                report[key] = (nearest['previousHeader'][key], header[key])
+        return report
+
+    def _candidates(self, context):
+        """
+        Returns the invocation digests of the manifests to diff against.
+        """
+        manifests_dir = os.path.dirname(self.digester.manifest_path(''))
+        try:
+            names = [n for n in os.listdir(manifests_dir) if n.endswith('.jsonl')]
+        except OSError:
+            return []
+        headers = []
+        for name in names:
+            path = os.path.join(manifests_dir, name)
+            try:
+                with open(path, 'r') as f:
+                    header = json.loads(f.readline())
+                # The manifests are touched when they are used again.
+                last_used = max(header['time'], os.path.getmtime(path))
+            except (OSError, ValueError):
+                continue
+            headers.append((name[:-len('.jsonl')], header, last_used))
+        same_context = [h for h in headers if h[1]['context'] == context]
+        headers = same_context or headers
+        headers.sort(key=lambda h: h[2], reverse=True)
+        return [digest for digest, _, _ in headers[:self.MAX_CANDIDATES]]
+
+
+def _read_manifest(f):
+    """
+    Reads a manifest (see [[BuildContextDigester.manifest_path]]).
+
+    Return:
+        The header, and a map of relative paths to "(digest, size)" pairs.
+    """
+    header = json.loads(f.readline())
+    files = {}
+    for line in f:
+        relpath, digest, size = json.loads(line)
+        files[relpath] = (digest, size)
+    return header, files
+
+
+def _diff_manifests(previous_files, files):
+    """
+    Diffs the files of two manifests.
+
+    Return:
+        A map with the "added", "removed" and "modified" files as lists of
+        "(relpath, bytes)" pairs ranked by bytes, and the total number of
+        "changedBytes".
+    """
+    added = [(relpath, files[relpath][1])
+             for relpath in files
+             if relpath not in previous_files]
+    removed = [(relpath, previous_files[relpath][1])
+               for relpath in previous_files
+               if relpath not in files]
+    modified = [(relpath, max(files[relpath][1], previous_files[relpath][1]))
+                for relpath in files
+                if relpath in previous_files and
+                files[relpath][0] != previous_files[relpath][0]]
+    for changes in [added, removed, modified]:
+        changes.sort(key=lambda change: change[1], reverse=True)
+    return {
+        'added': added,
+        'removed': removed,
+        'modified': modified,
+        'changedBytes': sum(
+            change[1] for change in added + removed + modified),
+    }
+
+
+def inspect_images(imgrefs):
+    """
+    Inspects images, in as few "docker image inspect" invocations as possible.
+
+    Args:
+        imgrefs: The references (or IDs) of the images to inspect.
+
+    Return:
+        A map of the image references to the output of "docker image inspect"
+        for them.  Images that cannot be found are missing from the map.
+    """
+    images = {}
+    for batch in _batches(imgrefs):
+        p = subprocess.run(['docker', 'image', 'inspect'] + batch,
+                           capture_output=True,
+                           encoding='utf8')
+        missing = set(re.findall(r'No such image: (\S+)', p.stderr))
+        found = [
+            ref for ref in batch if ref not in missing and
+            _with_default_tag(ref) not in missing
+        ]
+        inspected = json.loads(p.stdout or '[]')
+        if len(found) == len(inspected):
+            images.update(zip(found, inspected))
+            continue
+        # The missing images could not be told apart from the error
+        # messages: inspect the images one by one.
+        for ref in batch:
+            p = subprocess.run(['docker', 'image', 'inspect', ref],
+                               capture_output=True,
+                               encoding='utf8')
+            if p.returncode == 0:
+                images[ref] = json.loads(p.stdout)[0]
+    return images
+
+
+def _with_default_tag(imgref):
+    """
+    Returns an image reference with the implicit "latest" tag made explicit,
+    as the Docker daemon does in its error messages.
+    """
+    name = imgref[imgref.rfind('/') + 1:]
+    if ':' in name or '@' in name:
+        return imgref
+    return imgref + ':latest'
+
+
+def _batches(items, size=500):
+    """
+    Splits a list into batches, to keep command lines short enough.
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _parse_docker_timestamp(timestamp):
+    """
+    Parses an RFC 3339 timestamp as given by Docker.
+
+    Return:
+        A POSIX timestamp.
+    """
+    match = re.match(
+        r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(\.\d+)?(Z|[+-]\d{2}:\d{2})$',
+        timestamp)
+    if not match:
+        raise ValueError(f"unexpected timestamp '{timestamp}'")
+    seconds = datetime.datetime.strptime(
+        match.group(1),
+        '%Y-%m-%dT%H:%M:%S').replace(tzinfo=datetime.timezone.utc).timestamp()
+    if match.group(3) != 'Z':
+        sign = 1 if match.group(3)[0] == '+' else -1
+        seconds -= sign * (int(match.group(3)[1:3]) * 3600 +
+                           int(match.group(3)[4:6]) * 60)
+    return seconds + float(match.group(2) or 0)
+
+
+def _parse_size(size):
+    """
+    Parses a size given as a number of bytes, optionally with a "K", "M",
+    "G" or "T" suffix (powers of 1024).
+    """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def _walk_build_context(build_context_path):
+    """
+    Walks a build context, in the same way as "os.walk" does (symbolic links
+    to folders are not followed).
+
+    The files are given in the order of their relative paths, as
+    "sorted" would sort them, without ever listing all the files at once.
+    This is done by sorting the entries of each folder with the folders
+    suffixed with a path separator, as all the relative paths of the files
+    in a folder share this prefix.
+
+    Args:
+        build_context_path: Path to the build context.
+
+    Return:
+        An iterator over pairs of relative paths and paths.
+    """
+
+    def walk(dir_path, relpath_prefix):
+        try:
+            with os.scandir(dir_path) as it:
+                entries = list(it)
+        except OSError:
+            return
+        keyed_entries = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if not entry.is_symlink():
+                    keyed_entries.append((entry.name + os.sep, entry))
+            else:
+                keyed_entries.append((entry.name, entry))
+        keyed_entries.sort(key=lambda keyed_entry: keyed_entry[0])
+        for key, entry in keyed_entries:
+            if key.endswith(os.sep):
+                yield from walk(entry.path, relpath_prefix + key)
+            else:
+                yield relpath_prefix + key, entry.path
+
+    return walk(build_context_path, '')
+
+
+def _digest_file(file, algorithm=DEFAULT_DIGEST_ALGORITHM):
     """
     Digests a single file.
 
     Args:
         file: The path to the file to digest.
+        algorithm: The hash algorithm to use (one of the keys of
+            DIGEST_ALGORITHMS).
 
     Return:
         A hex digest (a string).
     """
     BUF_SIZE = 65536
 
-    m = hashlib.sha256()
+    m = DIGEST_ALGORITHMS[algorithm]()
     with open(file, 'rb') as f:
         while True:
             buf = f.read(BUF_SIZE)
@@ -233,32 +1649,230 @@ def _digest_file(file):
     return m.hexdigest()
 
 
-def _digest_string(s):
+def _digest_file_chunks(file, size, algorithm, chunk_size):
     """
-    Digests a string.
+    Digests a file chunk by chunk.  The chunks are digested in parallel.
 
     Args:
-        s: The string to digest.
+        file: The path to the file to digest.
+        size: The size of the file.
+        algorithm: The hash algorithm to use (one of the keys of
+            DIGEST_ALGORITHMS).
+        chunk_size: The size of the chunks.
+
+    Return:
+        The list of the hex digests of the chunks.
+    """
+    BUF_SIZE = 1024 * 1024
+
+    def digest_chunk(offset):
+        m = DIGEST_ALGORITHMS[algorithm]()
+        with open(file, 'rb') as f:
+            f.seek(offset)
+            remaining = chunk_size
+            while remaining > 0:
+                buf = f.read(min(BUF_SIZE, remaining))
+                if not buf:
+                    break
+                m.update(buf)
+                remaining -= len(buf)
+        return m.hexdigest()
+
+    # hashlib releases the GIL while digesting large buffers.
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(32, os.cpu_count() or 1)) as executor:
+        return list(
+            executor.map(digest_chunk, range(0, max(size, 1), chunk_size)))
+
+
+def _digest_chunk_list(chunks, algorithm):
+    """
+    Digests a file from the digests of its chunks.
+
+    Args:
+        chunks: The list of the hex digests of the chunks.
+        algorithm: The hash algorithm to use (one of the keys of
+            DIGEST_ALGORITHMS).
 
     Return:
         A hex digest (a string).
     """
-    m = hashlib.sha256()
-    m.update(s.encode('utf8'))
+    m = DIGEST_ALGORITHMS[algorithm]()
+    m.update('\n'.join(chunks).encode('utf8'))
     return m.hexdigest()
 
 
-def _digest_json(o):
+class _FileDigestCache:
+    """
+    Local cache of the digests of large files, so that they are not read
+    again as long as they are not modified.
+
+    Entries are keyed by absolute path and are only valid as long as the
+    size, modification time and inode of the file are unchanged.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: The path to the JSON file the cache is persisted to.
+        """
+        self.path = path
+        self.entries = self._load()
+        self.updated = set()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, file, stat, algorithm, chunk_size):
+        """
+        Gets the cache entry for a file, or "None" if there is no valid entry.
+        """
+        entry = self.entries.get(os.path.abspath(file))
+        if entry and entry == {
+                **entry,
+                **self._key(stat, algorithm, chunk_size)
+        }:
+            return entry
+        return None
+
+    def put(self, file, stat, algorithm, chunk_size, digest):
+        """
+        Puts an entry for a file in the cache.
+
+        Return:
+            The entry.
+        """
+        entry = {
+            **self._key(stat, algorithm, chunk_size),
+            'digest': digest,
+        }
+        file = os.path.abspath(file)
+        self.entries[file] = entry
+        self.updated.add(file)
+        return entry
+
+    def save(self):
+        """
+        Persists the cache, if it was modified.  The entries put since the
+        cache was loaded are merged with the ones persisted in the meantime
+        by concurrent digesters.  The entries of the files that do not exist
+        anymore are dropped.
+        """
+        if not self.updated:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with _lock_file(self.path):
+            entries = self._load()
+            entries.update(
+                {file: self.entries[file] for file in self.updated})
+            entries = {
+                file: entry
+                for file, entry in entries.items()
+                if os.path.exists(file)
+            }
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path),
+                                            suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(entries, f)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        self.entries = entries
+        self.updated = set()
+
+    def _key(self, stat, algorithm, chunk_size):
+        return {
+            'size': stat.st_size,
+            'mtimeNs': stat.st_mtime_ns,
+            'inode': stat.st_ino,
+            'algorithm': algorithm,
+            'chunkSize': chunk_size,
+        }
+
+
+@contextlib.contextmanager
+def _lock_file(path, timeout=10):
+    """
+    Serializes the updates of a file between threads and processes, with a
+    lock folder next to it.  A lock older than the timeout is considered
+    stale and is broken.
+
+    Args:
+        path: The path to the file to lock.
+        timeout: For how long to wait for the lock, in seconds.
+    """
+    lock_path = path + '.lock'
+    deadline = time.time() + timeout
+    while True:
+        try:
+            os.mkdir(lock_path)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > timeout:
+                    os.rmdir(lock_path)
+                    continue
+            except OSError:
+                continue
+            if time.time() > deadline:
+                raise Exception(f"cannot acquire lock '{lock_path}'")
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.rmdir(lock_path)
+
+
+def _digest_json_streaming(o, streamed_key, streamed_items):
     """
-    Digests an object after having serializing it to JSON.
+    Digests an object after having serializing it to JSON, with
+    "json.dumps(o, sort_keys=True)", except that the value for one of the
+    keys is a map whose items are streamed.  The memory used does not grow with the
+    number of streamed items.
 
     Args:
-        o: The object to digest.
+        o: The object to digest, without the streamed key.
+        streamed_key: The key for the streamed map.
+        streamed_items: An iterator over the items of the streamed map, as
+            pairs of keys and values, in the order of the keys.
 
     Return:
         A hex digest (a string).
     """
-    return _digest_string(json.dumps(o, sort_keys=True))
+    FLUSH_SIZE = 1024
+
+    m = hashlib.sha256()
+    buf = []
+
+    def write(s):
+        buf.append(s)
+        if len(buf) >= FLUSH_SIZE:
+            m.update(''.join(buf).encode('utf8'))
+            buf.clear()
+
+    write('{')
+    for i, key in enumerate(sorted(list(o) + [streamed_key])):
+        if i > 0:
+            write(', ')
+        write(json.dumps(key) + ': ')
+        if key == streamed_key:
+            write('{')
+            for j, (item_key, item_value) in enumerate(streamed_items):
+                write((', ' if j > 0 else '') + json.dumps(item_key) + ': ' +
+                      json.dumps(item_value, sort_keys=True))
+            write('}')
+        else:
+            write(json.dumps(o[key], sort_keys=True))
+    write('}')
+
+    m.update(''.join(buf).encode('utf8'))
+    return m.hexdigest()
 
 
 class CLI:
@@ -288,13 +1902,152 @@ class CLI:
             description='Docker build with client-side caching')
         parser.add_argument('path', help='Path to the context')
         parser.add_argument('--iidfile', help='Path to the image id file')
+        self._add_digester_arguments(parser)
+        parser.add_argument(
+            '--image-store',
+            dest='image_store',
+            default=os.environ.get('CNABTOOLS_IMAGE_STORE'),
+            help='Path to a local image store to save built images to, and ' +
+            'to restore them from when they are missing from the daemon ' +
+            '(default: $CNABTOOLS_IMAGE_STORE)')
+        parser.add_argument(
+            '--image-store-max-size',
+            dest='image_store_max_size',
+            type=_parse_size,
+            default=os.environ.get('CNABTOOLS_IMAGE_STORE_MAX_SIZE'),
+            help='Maximum size of the image store (e.g., "20G") ' +
+            '(default: $CNABTOOLS_IMAGE_STORE_MAX_SIZE)')
+        parser.add_argument(
+            'args',
+            help='Other arguments to "docker build"',
+            nargs=argparse.REMAINDER)
+        args = parser.parse_args(sys.argv[2:])
+        image_store = None
+        if args.image_store:
+            image_store = ImageStore(
+                args.image_store, max_size=args.image_store_max_size)
+        Docker(
+            image_store=image_store,
+            **self._digester_kwargs(args)).build_with_client_cache(
+                args.path, args.iidfile, args.args or [])
+
+    def explain(self):
+        parser = argparse.ArgumentParser(
+            description='Explain why a build misses the client cache')
+        parser.add_argument('path', help='Path to the context')
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=20,
+            help='Maximum number of files to list per kind of change')
+        self._add_digester_arguments(parser)
         parser.add_argument(
             'args',
             help='Other arguments to "docker build"',
             nargs=argparse.REMAINDER)
         args = parser.parse_args(sys.argv[2:])
-        Docker().build_with_client_cache(args.path, args.iidfile, args.args or
-                                         [])
+        report = CacheMissExplainer(
+            BuildContextDigester(**self._digester_kwargs(args))).explain(
+                args.path, args.args or [])
+
+        print(f"Invocation digest: {report['digest']}")
+        if report['recorded']:
+            print("This build context has already been built: " +
+                  "it hits the client cache if the image is still tagged")
+            return
+        if 'previous' not in report:
+            print("No previous build context has been recorded")
+            return
+        print(f"Nearest previous invocation digest: {report['previous']} " +
+              "(recorded at " + datetime.datetime.fromtimestamp(
+                  report['previousHeader']['time']).isoformat() + ")")
+        for key in ['args', 'settings']:
+            if key in report:
+                print(f"{key.capitalize()} changed: {report[key][0]} -> " +
+                      f"{report[key][1]}")
+        print(f"{report['changedBytes']} bytes changed")
+        for kind in ['modified', 'added', 'removed']:
+            changes = report[kind]
+            print(f"{len(changes)} files {kind}:")
+            for relpath, size in changes[:args.limit]:
+                print(f"    {relpath} ({size} bytes)")
+            if len(changes) > args.limit:
+                print("    ...")
+
+    def _add_digester_arguments(self, parser):
+        parser.add_argument(
+            '--digest-algorithm',
+            dest='digest_algorithm',
+            choices=sorted(DIGEST_ALGORITHMS),
+            default=DEFAULT_DIGEST_ALGORITHM,
+            help='Hash algorithm to digest the files of the context with')
+        parser.add_argument(
+            '--chunk-threshold',
+            dest='chunk_threshold',
+            type=int,
+            help='Size, in bytes, from which files of the context are ' +
+            'digested chunk by chunk and their digests cached')
+        parser.add_argument(
+            '--chunk-size',
+            dest='chunk_size',
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help='Size, in bytes, of the chunks')
+
+    def _digester_kwargs(self, args):
+        return {
+            'digest_algorithm': args.digest_algorithm,
+            'chunk_threshold': args.chunk_threshold,
+            'chunk_size': args.chunk_size,
+        }
+
+    def gc(self):
+        parser = argparse.ArgumentParser(
+            description='Garbage-collect the client cache')
+        parser.add_argument(
+            '--max-age',
+            dest='max_age',
+            type=float,
+            help='Remove the entries not used for that many days')
+        parser.add_argument(
+            '--max-count',
+            dest='max_count',
+            type=int,
+            help='Maximum number of entries to keep')
+        parser.add_argument(
+            '--max-size',
+            dest='max_size',
+            type=_parse_size,
+            help='Maximum total size of the images to keep (e.g., "20G")')
+        parser.add_argument(
+            '--keep-bundle',
+            dest='keep_bundles',
+            action='append',
+            help='Keep the images referenced by this bundle.json file, or ' +
+            'by the bundle.json files in this folder')
+        parser.add_argument(
+            '--keep-bundle-max-age',
+            dest='keep_bundle_max_age',
+            type=float,
+            help='Only keep the images of the bundles modified within that ' +
+            'many days')
+        parser.add_argument(
+            '--dry-run',
+            dest='dry_run',
+            action='store_true',
+            help='Only report what would be removed')
+        args = parser.parse_args(sys.argv[2:])
+        ClientCacheGC().collect(
+            max_age=_days_to_seconds(args.max_age),
+            max_count=args.max_count,
+            max_size=args.max_size,
+            keep_bundles=args.keep_bundles,
+            keep_bundles_max_age=_days_to_seconds(args.keep_bundle_max_age),
+            dry_run=args.dry_run)
+
+
+def _days_to_seconds(days):
+    return None if days is None else days * 24 * 3600
 
 
 if __name__ == "__main__":
@@ -12,6 +12,9 @@ import sys
 import json
 import distutils.version
 import re
+import time
+import datetime
+import concurrent.futures
 
 from duffle import Duffle
 
@@ -48,7 +51,17 @@ def uninstall(duffle, app_name):
 
 
 def load_images(bundle_path):
-    if os.path.exists(os.path.join(bundle_path, 'images.tar')):
+    images_dir = os.path.join(bundle_path, 'images')
+    if os.path.isdir(images_dir):
+        print("Load Docker images...")
+        for name in sorted(os.listdir(images_dir)):
+            if name.endswith('.tar'):
+                subprocess.run([
+                    'docker', 'load', '--input',
+                    os.path.join(images_dir, name)
+                ],
+                               check=True)
+    elif os.path.exists(os.path.join(bundle_path, 'images.tar')):
         print("Load Docker images...")
         subprocess.run([
             'docker', 'load', '--input',
@@ -65,6 +78,232 @@ def load_images_from_registry(registry_spec):
     pass
 
 
+class AppSpec:
+    """
+    One application to process within an orchestration plan.
+    """
+
+    def __init__(self,
+                 name,
+                 bundle_path,
+                 action,
+                 set=None,
+                 set_file=None,
+                 depends_on=None):
+        """
+        Args:
+            name: The application (claim) name.
+            bundle_path: The path to the CNAB thick bundle of the application.
+            action: "install", "uninstall", or any other CNAB action.
+            set: Parameters as NAME=VALUE pairs.
+            set_file: Parameters from file content as NAME=SOURCE-PATH pairs.
+            depends_on: Names of the applications that must have been
+                processed successfully before this one is.
+        """
+        self.name = name
+        self.bundle_path = bundle_path
+        self.action = action
+        self.set = set or []
+        self.set_file = set_file or []
+        self.depends_on = depends_on or []
+
+
+def read_plan(plan_path):
+    """
+    Reads an orchestration plan.
+
+    The plan is a JSON file of the form:
+
+        {
+          "apps": [
+            {
+              "name": "db",
+              "bundle": "../db",
+              "action": "install",
+              "set": ["NAME=VALUE"],
+              "setFile": ["NAME=SOURCE-PATH"],
+              "dependsOn": []
+            }
+          ]
+        }
+
+    Relative bundle paths are resolved against the folder of the plan.
+
+    Args:
+        plan_path: The path to the plan.
+
+    Return:
+        A list of AppSpec objects.
+    """
+    with open(plan_path, 'r') as f:
+        plan = json.load(f)
+    plan_dir = os.path.dirname(os.path.abspath(plan_path))
+    apps = []
+    for app in plan['apps']:
+        bundle_path = os.path.join(plan_dir, app['bundle'])
+        apps.append(
+            AppSpec(
+                name=app.get('name', os.path.basename(bundle_path)),
+                bundle_path=bundle_path,
+                action=app['action'],
+                set=app.get('set'),
+                set_file=app.get('setFile'),
+                depends_on=app.get('dependsOn')))
+    return apps
+
+
+def orchestrate(duffle, apps, jobs=4, skip_load=False):
+    """
+    Processes multiple applications concurrently, in dependency order.
+
+    All the applications share the same Duffle installation.  The images
+    of the bundles to install are loaded in a single phase before any
+    application is processed.  A failure only affects the application
+    that failed and the applications that depend on it.
+
+    Args:
+        duffle: The Duffle object to use for all the applications.
+        apps: A list of AppSpec objects.
+        jobs: The maximum number of applications to process concurrently.
+        skip_load: Skip loading the images.
+
+    Return:
+        A map of application names to results.  Results are maps with
+        a "status" ("ok", "failed" or "skipped"), a "duration" in seconds,
+        and, for failed applications, an "error".
+    """
+    by_name = {}
+    for app in apps:
+        if app.name in by_name:
+            raise Exception(f"duplicate application name '{app.name}'")
+        by_name[app.name] = app
+    for app in apps:
+        for dep in app.depends_on:
+            if dep not in by_name:
+                raise Exception(
+                    f"application '{app.name}' depends on unknown " +
+                    f"application '{dep}'")
+    _check_acyclic(by_name)
+
+    results = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        load_failures = {}
+        if not skip_load:
+            bundle_paths = sorted(
+                set(
+                    os.path.realpath(app.bundle_path)
+                    for app in apps
+                    if app.action == 'install'))
+            futures = {
+                executor.submit(load_images, bundle_path): bundle_path
+                for bundle_path in bundle_paths
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    load_failures[futures[future]] = e
+
+        pending = dict(by_name)
+        running = {}
+        while pending or running:
+            for name in list(pending):
+                app = pending[name]
+                failed_deps = [
+                    dep for dep in app.depends_on
+                    if dep in results and results[dep]['status'] != 'ok'
+                ]
+                if failed_deps:
+                    del pending[name]
+                    results[name] = {
+                        'status': 'skipped',
+                        'duration': 0,
+                        'error': 'dependencies did not succeed: ' +
+                                 ', '.join(failed_deps),
+                    }
+                    print(f"[{name}] skipped")
+                    continue
+                if any(dep not in results for dep in app.depends_on):
+                    continue
+                del pending[name]
+                load_failure = load_failures.get(
+                    os.path.realpath(app.bundle_path))
+                running[executor.submit(_process_app, duffle, app,
+                                        load_failure)] = name
+            if not running:
+                continue
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+
+    return results
+
+
+def _process_app(duffle, app, load_failure):
+    """
+    Processes one application of an orchestration plan.
+
+    Return:
+        The result for the application (see [[orchestrate]]).
+    """
+    print(f"[{app.name}] {app.action}...")
+    start = time.time()
+    try:
+        if load_failure:
+            raise Exception("cannot load images") from load_failure
+        if app.action == 'install':
+            install(
+                duffle,
+                skip_load=True,
+                app_name=app.name,
+                bundle_path=app.bundle_path,
+                set=app.set,
+                set_file=app.set_file)
+        elif app.action == 'uninstall':
+            uninstall(duffle, app_name=app.name)
+        else:
+            run(duffle,
+                action=app.action,
+                app_name=app.name,
+                set=app.set,
+                set_file=app.set_file)
+    except Exception as e:
+        duration = time.time() - start
+        print(f"[{app.name}] {app.action} failed: {e}")
+        return {'status': 'failed', 'duration': duration, 'error': str(e)}
+    duration = time.time() - start
+    print(f"[{app.name}] {app.action} done in " +
+          f"{datetime.timedelta(seconds=duration)}")
+    return {'status': 'ok', 'duration': duration}
+
+
+def _check_acyclic(by_name):
+    """
+    Checks that the dependencies between applications have no cycle.
+
+    Args:
+        by_name: A map of application names to AppSpec objects.
+    """
+    visited = set()
+    visiting = set()
+
+    def visit(name, path):
+        if name in visited:
+            return
+        if name in visiting:
+            raise Exception("dependency cycle: " + " -> ".join(path + [name]))
+        visiting.add(name)
+        for dep in by_name[name].depends_on:
+            visit(dep, path + [name])
+        visiting.remove(name)
+        visited.add(name)
+
+    for name in by_name:
+        visit(name, [])
+
+
 class Make:
     """
     Command-Line Interface.
@@ -150,6 +389,35 @@ class Make:
         args = parser.parse_args(sys.argv[2:])
         uninstall(self._duffle(), app_name=args.name)
 
+    def orchestrate(self):
+        parser = argparse.ArgumentParser(
+            description='Process multiple applications concurrently')
+        parser.add_argument(
+            'plan', help='Path to the orchestration plan (a JSON file)')
+        parser.add_argument(
+            '-j',
+            '--jobs',
+            type=int,
+            default=4,
+            help='Maximum number of applications to process concurrently')
+        parser.add_argument(
+            '--skip-load',
+            dest='skip_load',
+            action='store_true',
+            help='Skip loading the images')
+        args = parser.parse_args(sys.argv[2:])
+        results = orchestrate(
+            self._duffle(),
+            read_plan(args.plan),
+            jobs=args.jobs,
+            skip_load=args.skip_load)
+        print("Summary:")
+        for name, result in results.items():
+            delta = datetime.timedelta(seconds=result['duration'])
+            print(f"    {name}: {result['status']} ({delta})")
+        if any(result['status'] != 'ok' for result in results.values()):
+            sys.exit(1)
+
     def _duffle(self):
         return Duffle(
             bundle_path=self.bundle_path,
@@ -0,0 +1,223 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2020 Hadrien Chauvin
+
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from cnabtools.docker import (AsyncDocker, BuildContextDigester,
+                              _FileDigestCache, _digest_json_streaming,
+                              _walk_build_context, inspect_images)
+
+
+def legacy_digest_build_invocation(build_context_path, build_invocation_args):
+    """
+    The digest of build invocations, as computed before it could be streamed
+    or configured.
+    """
+    digests = {}
+    for dp, dn, filenames in os.walk(build_context_path):
+        for f in filenames:
+            path = os.path.join(dp, f)
+            m = hashlib.sha256()
+            with open(path, 'rb') as fo:
+                m.update(fo.read())
+            digests[os.path.relpath(path, build_context_path)] = m.hexdigest()
+    return hashlib.sha256(
+        json.dumps({
+            'digests': digests,
+            'args': build_invocation_args,
+        },
+                   sort_keys=True).encode('utf8')).hexdigest()
+
+
+class TempDirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def write(self, relpath, content='x'):
+        path = os.path.join(self.tmp_dir, 'context', relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf8') as f:
+            f.write(content)
+        return path
+
+
+class DigestCompatibilityTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.context = os.path.join(self.tmp_dir, 'context')
+        for relpath in [
+                'a.txt', 'a/b', 'a/c.txt', 'a-b', 'a b', 'a!', 'a0', 'A',
+                'é.txt', 'e/ü/ß', 'e.txt', 'z/z/z', '日本/語'
+        ]:
+            self.write(relpath, relpath)
+        os.symlink('a.txt', os.path.join(self.context, 'link-to-file'))
+        os.symlink('a', os.path.join(self.context, 'link-to-dir'))
+
+    def test_walk_order(self):
+        expected = []
+        for dp, dn, filenames in os.walk(self.context):
+            for f in filenames:
+                expected.append(
+                    os.path.relpath(os.path.join(dp, f), self.context))
+        self.assertEqual(
+            [relpath for relpath, _ in _walk_build_context(self.context)],
+            sorted(expected))
+
+    def test_streaming_json(self):
+        o = {'args': ['--build-arg', 'é=1'], 'zzz': {'b': 1, 'a': [2]}}
+        items = [('a b', 'x'), ('a-b', 'y'), ('a.txt', 'z'), ('a/b', 'é')]
+        self.assertEqual(
+            _digest_json_streaming(o, 'digests', iter(items)),
+            hashlib.sha256(
+                json.dumps({
+                    **o, 'digests': dict(items)
+                }, sort_keys=True).encode('utf8')).hexdigest())
+
+    def test_default_digest(self):
+        digester = BuildContextDigester(
+            cache_dir=os.path.join(self.tmp_dir, 'cache'))
+        for args in [[], ['--build-arg', 'A=é'], None]:
+            self.assertEqual(
+                digester.digest_build_invocation(self.context, args),
+                legacy_digest_build_invocation(self.context, args))
+
+    def test_recorded_manifest(self):
+        digester = BuildContextDigester(
+            cache_dir=os.path.join(self.tmp_dir, 'cache'))
+        digest = digester.digest_build_invocation(
+            self.context, [], record_manifest=True)
+        self.assertEqual(digest,
+                         legacy_digest_build_invocation(self.context, []))
+        self.assertTrue(os.path.exists(digester.manifest_path(digest)))
+
+    def test_chunked_digest_is_stable(self):
+        self.write('big', 'y' * 10000)
+        kwargs = {
+            'cache_dir': os.path.join(self.tmp_dir, 'cache'),
+            'chunk_threshold': 1000,
+            'chunk_size': 1024,
+        }
+        digest = BuildContextDigester(**kwargs).digest_build_invocation(
+            self.context, [])
+        self.assertNotEqual(digest,
+                            legacy_digest_build_invocation(self.context, []))
+        # Digested again from the file digest cache.
+        self.assertEqual(
+            BuildContextDigester(**kwargs).digest_build_invocation(
+                self.context, []), digest)
+
+
+class FileDigestCacheTest(TempDirTestCase):
+
+    def test_concurrent_saves_are_merged(self):
+        cache_path = os.path.join(self.tmp_dir, 'cache', 'file-digests.json')
+        files = [self.write(str(i)) for i in range(20)]
+
+        def put(file):
+            cache = _FileDigestCache(cache_path)
+            cache.put(file, os.stat(file), 'sha256', 1024, file)
+            cache.save()
+
+        threads = [threading.Thread(target=put, args=(f,)) for f in files]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        cache = _FileDigestCache(cache_path)
+        for file in files:
+            self.assertEqual(
+                cache.get(file, os.stat(file), 'sha256', 1024)['digest'],
+                file)
+        self.assertEqual(os.listdir(os.path.dirname(cache_path)),
+                         ['file-digests.json'])
+
+    def test_modified_file_is_not_cached(self):
+        cache_path = os.path.join(self.tmp_dir, 'file-digests.json')
+        file = self.write('f')
+        cache = _FileDigestCache(cache_path)
+        cache.put(file, os.stat(file), 'sha256', 1024, 'digest')
+        self.write('f', 'changed')
+        self.assertIsNone(cache.get(file, os.stat(file), 'sha256', 1024))
+
+
+class InspectImagesTest(unittest.TestCase):
+
+    def test_missing_image_with_implicit_tag(self):
+        result = subprocess.CompletedProcess(
+            [],
+            1,
+            stdout=json.dumps([{
+                'Id': 'sha256:b'
+            }]),
+            stderr='Error response from daemon: No such image: foo:latest\n')
+        with mock.patch('subprocess.run', return_value=result) as run:
+            images = inspect_images(['foo', 'bar:1'])
+        self.assertEqual(images, {'bar:1': {'Id': 'sha256:b'}})
+        run.assert_called_once()
+
+
+class AsyncDockerTest(TempDirTestCase):
+
+    def test_concurrent_builds_are_shared(self):
+        self.write('Dockerfile')
+        docker = AsyncDocker(cache_dir=os.path.join(self.tmp_dir, 'cache'))
+        commands = []
+
+        async def run(args, check=False, output=None, buildkit=True):
+            commands.append(args[1])
+            await asyncio.sleep(0.01)
+            if args[1] == 'build':
+                with open(args[args.index('--iidfile') + 1], 'w') as f:
+                    f.write('sha256:abc')
+            if args[1] == 'inspect':
+                return 1, None
+            return 0, None
+
+        async def build_all():
+            return await asyncio.gather(*[
+                docker.build_with_client_cache(
+                    os.path.join(self.tmp_dir, 'context')) for _ in range(3)
+            ])
+
+        with mock.patch.object(docker, '_run', run):
+            image_ids = asyncio.run(build_all())
+        self.assertEqual(image_ids, ['sha256:abc'] * 3)
+        self.assertEqual(commands.count('build'), 1)
+
+    def test_manifest_is_recorded_once(self):
+        self.write('Dockerfile')
+        context = os.path.join(self.tmp_dir, 'context')
+        docker = AsyncDocker(cache_dir=os.path.join(self.tmp_dir, 'cache'))
+
+        async def run(args, check=False, output=None, buildkit=True):
+            return 0, 'sha256:abc'
+
+        with mock.patch.object(docker, '_run', run):
+            digest = asyncio.run(docker.digest_build_invocation(context, []))
+            manifest_path = docker.digester.manifest_path(digest)
+            asyncio.run(docker.build_with_client_cache(context))
+            self.assertTrue(os.path.exists(manifest_path))
+            with mock.patch.object(docker.digester,
+                                   '_digest_build_invocation',
+                                   wraps=docker.digester._digest_build_invocation
+                                  ) as digest_build_invocation:
+                asyncio.run(docker.build_with_client_cache(context))
+        # Only digested, without recording the manifest again.
+        digest_build_invocation.assert_called_once_with(context, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,7 +11,57 @@ import os
 import json
 import subprocess
 import shutil
-import atexit
+import tempfile
+import hashlib
+import tarfile
+import time
+import contextlib
+import datetime
+import re
+
+#: Size of the chunks in which file parameters are written.
+WRITE_CHUNK_SIZE = 1 << 20
+
+#: Maximum size, in bytes, of a line of an env-file: Docker reads
+#: env-files with a line scanner capped at 64 KiB.
+ENV_FILE_MAX_LINE = 64 * 1024 - 1
+
+#: Folder of the container where the environment variables too large for
+#: an env-file are written, with bulk I/O (see [[environment_flags]]).
+ENV_FILES_DIR = '/cnab/app/env'
+
+#: Label given to the containers of the warm pool.  The value is the
+#: pool key.
+POOL_LABEL = 'io.chauvin.docker2.pool'
+
+#: Label giving the idle timeout, in seconds, of a warm pool container.
+POOL_IDLE_TIMEOUT_LABEL = 'io.chauvin.docker2.idle-timeout'
+
+#: Prefix of the names of the warm pool containers.
+POOL_NAME_PREFIX = 'cnab-docker2-pool-'
+
+#: Command that keeps a warm pool container alive, until it has been idle
+#: for "{idle_timeout}" seconds: the operations run in the container mark
+#: it as used (see POOL_EXEC_SCRIPT).
+POOL_KEEPALIVE_SCRIPT = (
+    'trap "exit 0" TERM INT; while :; do sleep {idle_timeout} & wait $!; '
+    'set -- /tmp/.cnab-docker2-used*; [ -e "$1" ] || exit 0; '
+    'rm -f /tmp/.cnab-docker2-used; done')
+
+#: Command that runs an operation, given as arguments, in a warm pool
+#: container.  The container is marked as busy while the operation runs, and
+#: as used once it is done.
+POOL_EXEC_SCRIPT = (
+    'touch /tmp/.cnab-docker2-used-$$; "$@"; s=$?; '
+    'rm -f /tmp/.cnab-docker2-used-$$; touch /tmp/.cnab-docker2-used; exit $s')
+
+#: Name of the JSON lines file, in the metrics folder, where the phase
+#: durations of each operation are appended.
+METRICS_JSONL_FILE = 'cnab-docker2.jsonl'
+
+#: Name of the Prometheus textfile, in the metrics folder, where the
+#: phase durations are aggregated.
+METRICS_PROM_FILE = 'cnab_docker2.prom'
 
 
 def main(option):
@@ -20,9 +70,14 @@ def main(option):
         print("docker")
     elif option == "--help":
         print("Alternative Duffle driver for the local Docker daemon")
+    elif option == "--prune-pool":
+        # Remove the warm pool containers that have been idle for too long
+        prune_pool()
     elif not option:
-        operation = json.load(sys.stdin)
-        run(operation)
+        metrics = Metrics()
+        with metrics.phase('parse'):
+            operation = json.load(sys.stdin)
+        run(operation, metrics)
     else:
         print(f"Unexpected option '{option}'", file=sys.stderr)
         sys.exit(1)
@@ -30,8 +85,19 @@ def main(option):
 
 class Config:
 
-    def __init__(self, allow_docker_host_access=False):
+    def __init__(self,
+                 allow_docker_host_access=False,
+                 warm_pool=False,
+                 warm_pool_idle_timeout=600,
+                 warm_pool_max_size=4,
+                 bulk_io=False,
+                 scratch_file_mode=0o644):
         self.allow_docker_host_access = allow_docker_host_access
+        self.warm_pool = warm_pool
+        self.warm_pool_idle_timeout = warm_pool_idle_timeout
+        self.warm_pool_max_size = warm_pool_max_size
+        self.bulk_io = bulk_io
+        self.scratch_file_mode = scratch_file_mode
 
 
 def parse_config(operation):
@@ -40,30 +106,181 @@ def parse_config(operation):
                                              {}).get('io.chauvin.docker2', {})
     return Config(
         allow_docker_host_access=custom_extension.get(
-            'allow-docker-host-access', False))
+            'allow-docker-host-access', False),
+        warm_pool=custom_extension.get('warm-pool', False),
+        warm_pool_idle_timeout=custom_extension.get('warm-pool-idle-timeout',
+                                                    600),
+        warm_pool_max_size=custom_extension.get('warm-pool-max-size', 4),
+        bulk_io=custom_extension.get('bulk-io', False),
+        scratch_file_mode=parse_file_mode(
+            custom_extension.get('scratch-file-mode', '0644')))
+
+
+def parse_file_mode(mode):
+    """
+    Parses a file mode given in octal, as a string (e.g., "0644") or as a
+    JSON number whose digits are octal (e.g., 644).
+    """
+    try:
+        parsed = int(str(mode), 8)
+    except ValueError:
+        parsed = -1
+    if isinstance(mode, bool) or not 0 <= parsed <= 0o777:
+        raise Exception(f"invalid scratch-file-mode '{mode}'")
+    return parsed
+
+
+def scratch_root():
+    """
+    Returns the folder under which to create the per-operation scratch
+    folders.
 
+    The folder is taken from the CNAB_DOCKER2_TMPDIR environment variable,
+    if set.  Otherwise, tmpfs ("/dev/shm") is preferred when available.
+    Otherwise, the default temporary folder is used.  Note that the folder
+    must be visible to the Docker daemon, as it is bind-mounted.
+    """
+    root = os.environ.get('CNAB_DOCKER2_TMPDIR')
+    if root:
+        return root
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return None
 
-def run(operation):
+
+def make_scratch_dir():
+    """
+    Creates a scratch folder that is unique to the current operation, so
+    that concurrent invocations of the driver do not interfere.
+
+    The folder is only accessible to its owner, so that other local users
+    cannot read the files in it.  This does not prevent containers from
+    reading the bind-mounted files, whatever user they run as, as the
+    permissions of the folder do not apply through the mount point: only
+    the file mode does (see [[write_file]]).
+
+    Return:
+        The absolute path to the scratch folder.
+    """
+    scratch_dir = tempfile.mkdtemp(prefix='cnab-docker2-', dir=scratch_root())
+    os.chmod(scratch_dir, 0o700)
+    return os.path.abspath(scratch_dir)
+
+
+def write_file(path, content, mode=0o644):
+    """
+    Writes a file parameter, chunk by chunk, so that the content is never
+    encoded all at once.
+
+    By default, the file is readable by everyone, so that invocation images
+    that run as a non-root user can read it when it is bind-mounted.  Other
+    local users are kept out by the scratch folder (see
+    [[make_scratch_dir]]).  Set "scratch-file-mode" in the custom extension
+    (e.g., to "0600") to restrict the files to images that run as the user
+    of the driver.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+    os.chmod(path, mode)
+    with open(fd, 'w', encoding='utf8', newline='') as f:
+        for i in range(0, len(content), WRITE_CHUNK_SIZE):
+            f.write(content[i:i + WRITE_CHUNK_SIZE])
+
+
+def environment_flags(operation, config, scratch_dir):
+    """
+    Returns the flags to "docker create", "docker run" or "docker exec" that
+    set the environment of the container.  Note that "docker exec" only
+    accepts "--env-file" as of Docker 20.10.
+
+    With bulk I/O, the environment is passed in an env-file written to the
+    scratch folder, except for multi-line values, which an env-file cannot
+    hold and are passed with "-e".  Values too large for an env-file line or
+    a command-line argument (see ENV_FILE_MAX_LINE) are neither: they are
+    written to a file of ENV_FILES_DIR, named after the variable, and the
+    "<name>_FILE" variable gives the path to the file.  Otherwise, each
+    variable is passed with "-e".
+
+    Return:
+        The flags, and a map of container paths to the contents of the
+        files to copy into the container.
+    """
+    environment = operation['environment']
+    if not config.bulk_io:
+        args = []
+        for name in environment:
+            args += ['-e', name + '=' + environment[name]]
+        return args, {}
+
+    env_file = os.path.join(scratch_dir, 'env')
+    args = ['--env-file', env_file]
+    files = {}
+    fd = os.open(env_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with open(fd, 'w', encoding='utf8', newline='') as f:
+        for name in environment:
+            value = environment[name]
+            if Utf8Reader(name + '=' + value).size > ENV_FILE_MAX_LINE:
+                path = ENV_FILES_DIR + '/' + name
+                files[path] = value
+                f.write(name + '_FILE=' + path + '\n')
+            elif '\n' in value or '\r' in value:
+                args += ['-e', name + '=' + value]
+            else:
+                f.write(name + '=' + value + '\n')
+    return args, files
+
+
+def run(operation, metrics=None):
+    if not metrics:
+        metrics = Metrics()
     config = parse_config(operation)
 
-    volumes = []
-    if config.allow_docker_host_access:
-        volumes += ['/var/run/docker.sock:/var/run/docker.sock']
-    if len(operation['files']) > 0:
-        files_to_mount_dir = os.path.abspath(".cnab_tmp")
-        shutil.rmtree(files_to_mount_dir, ignore_errors=True)
-        os.mkdir(files_to_mount_dir)
-
-        def remove_files_to_mount_dir():
-            shutil.rmtree(files_to_mount_dir, ignore_errors=True)
-
-        atexit.register(remove_files_to_mount_dir)
-
-        for i, container_path in enumerate(operation['files']):
-            local_path = f'{files_to_mount_dir}/{i}'
-            with open(local_path, 'w') as f:
-                f.write(operation['files'][container_path])
-            volumes.append(local_path + ':' + container_path + ':ro')
+    succeeded = False
+    scratch_dir = None
+    try:
+        volumes = []
+        if config.allow_docker_host_access:
+            volumes += ['/var/run/docker.sock:/var/run/docker.sock']
+        if metrics.enabled:
+            with metrics.phase('image_check'):
+                subprocess.run(
+                    ['docker', 'image', 'inspect', operation['image']['image']],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL)
+        with metrics.phase('staging'):
+            if config.bulk_io:
+                scratch_dir = make_scratch_dir()
+            env_flags, env_files = environment_flags(operation, config,
+                                                     scratch_dir)
+            if env_files:
+                operation = {
+                    **operation, 'files': {
+                        **operation['files'],
+                        **env_files
+                    }
+                }
+        if config.warm_pool and run_in_pool(operation, config, volumes,
+                                            env_flags, metrics):
+            succeeded = True
+            return
+        with metrics.phase('staging'):
+            # With bulk I/O, the files are copied into the container once it
+            # is created.
+            if not config.bulk_io and len(operation['files']) > 0:
+                scratch_dir = make_scratch_dir()
+                for i, container_path in enumerate(operation['files']):
+                    local_path = os.path.join(scratch_dir, str(i))
+                    write_file(local_path, operation['files'][container_path],
+                               config.scratch_file_mode)
+                    volumes.append(local_path + ':' + container_path + ':ro')
+        run_container(operation, config, volumes, env_flags, metrics)
+        succeeded = True
+    finally:
+        if scratch_dir:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+        metrics.write(operation, succeeded)
+
+
+def run_container(operation, config, volumes, env_flags, metrics):
     if operation['outputs'] and len(operation['outputs']) > 0:
         pass
         # print("WARNING: 'outputs' is currently a NO-OP")
@@ -72,21 +289,604 @@ def run(operation):
         # assert output_local_dir, 'expected CNAB_OUTPUT_DIR to have been set'
         # volumes.append(output_local_dir + ':/cnab/app/outputs')
 
-    args = ['docker', 'run', '--rm']
-    if config.allow_docker_host_access:
-        args += ['--privileged', '--net', 'host']
-    for v in volumes:
-        args += ['-v', v]
-    for name in operation['environment']:
-        args += ['-e', name + '=' + operation['environment'][name]]
-    args += [
+    command = [
         operation['image']['image'],
         '/cnab/app/run',
         operation['action'],
     ]
 
-    subprocess.run(
-        args, check=True, stdout=sys.stderr.buffer, stderr=sys.stderr.buffer)
+    if not metrics.enabled and not config.bulk_io:
+        # Nothing needs to happen between the creation and the start of the
+        # container, so use a single "docker run".
+        args = ['docker', 'run', '--rm'] + docker_run_flags(config, volumes)
+        args += env_flags + command
+        subprocess.run(args,
+                       check=True,
+                       stdout=sys.stderr.buffer,
+                       stderr=sys.stderr.buffer)
+        return
+
+    args = ['docker', 'create'] + docker_run_flags(config, volumes) + env_flags
+    args += command
+
+    with metrics.phase('create'):
+        p = subprocess.run(
+            args, check=True, stdout=subprocess.PIPE, stderr=sys.stderr.buffer)
+    container = p.stdout.decode('utf8').strip()
+    try:
+        if config.bulk_io and len(operation['files']) > 0:
+            with metrics.phase('staging'):
+                copy_files_into_container(container, operation['files'])
+        start = time.time()
+        p = subprocess.run(['docker', 'start', '--attach', container],
+                           stdout=sys.stderr.buffer,
+                           stderr=sys.stderr.buffer)
+        elapsed = time.time() - start
+        runtime = container_runtime(container) if metrics.enabled else None
+        if runtime is None:
+            metrics.record('runtime', elapsed)
+        else:
+            metrics.record('start', max(elapsed - runtime, 0))
+            metrics.record('runtime', runtime)
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, p.args)
+    finally:
+        with metrics.phase('teardown'):
+            subprocess.run(['docker', 'rm', '--force', container],
+                           stdout=subprocess.DEVNULL,
+                           stderr=sys.stderr.buffer)
+
+
+def container_runtime(container):
+    """
+    Returns for how long, in seconds, a container that has exited ran, as
+    recorded by the Docker daemon, or "None" if this cannot be determined.
+    """
+    p = subprocess.run([
+        'docker', 'inspect', container, '--format',
+        '{{.State.StartedAt}} {{.State.FinishedAt}}'
+    ],
+                       capture_output=True,
+                       encoding='utf8')
+    if p.returncode != 0:
+        return None
+    try:
+        started_at, finished_at = [
+            parse_docker_timestamp(t) for t in p.stdout.split()
+        ]
+    except ValueError:
+        return None
+    return finished_at - started_at
+
+
+def parse_docker_timestamp(timestamp):
+    """
+    Parses an RFC 3339 timestamp, with nanoseconds, as given by
+    "docker inspect".
+
+    Return:
+        A POSIX timestamp.
+    """
+    match = re.match(r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(\.\d+)?Z$',
+                     timestamp)
+    if not match:
+        raise ValueError(f"unexpected timestamp '{timestamp}'")
+    seconds = datetime.datetime.strptime(
+        match.group(1),
+        '%Y-%m-%dT%H:%M:%S').replace(tzinfo=datetime.timezone.utc).timestamp()
+    return seconds + float(match.group(2) or 0)
+
+
+class Metrics:
+    """
+    Records the duration of the phases of an operation.
+
+    The metrics are only written if the CNAB_DOCKER2_METRICS_DIR environment
+    variable gives the folder where to write them.  They are written both
+    as JSON lines (one line per operation) and as a Prometheus textfile
+    (for the node exporter textfile collector).
+    """
+
+    def __init__(self):
+        self.metrics_dir = os.environ.get('CNAB_DOCKER2_METRICS_DIR')
+        self.phases = {}
+
+    @property
+    def enabled(self):
+        return bool(self.metrics_dir)
+
+    def record(self, phase, duration):
+        self.phases[phase] = self.phases.get(phase, 0) + duration
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(phase, time.time() - start)
+
+    def write(self, operation, succeeded):
+        """
+        Writes the metrics, if enabled.
+
+        Writing the metrics is best-effort: a failure only prints a warning,
+        so that it never changes the outcome of the operation.
+
+        Args:
+            operation: The operation the metrics are for.
+            succeeded: Whether the operation succeeded.
+        """
+        if not self.enabled:
+            return
+        try:
+            self._write(operation, succeeded)
+        except OSError as e:
+            print(f"WARNING: cannot write metrics: {e}", file=sys.stderr)
+
+    def _write(self, operation, succeeded):
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        labels = {
+            'bundle': operation.get('Bundle', {}).get('name', ''),
+            'action': operation.get('action', ''),
+            'image': operation.get('image', {}).get('image', ''),
+        }
+        result = 'success' if succeeded else 'failure'
+
+        line = json.dumps({
+            'time': time.time(),
+            'installation': operation.get('installation_name', ''),
+            **labels,
+            'result': result,
+            'phases': self.phases,
+        },
+                          sort_keys=True)
+        with open(os.path.join(self.metrics_dir, METRICS_JSONL_FILE),
+                  'a') as f:
+            f.write(line + '\n')
+
+        with self._lock():
+            self._update_prom_file(labels, result)
+
+    def _update_prom_file(self, labels, result):
+        prom_path = os.path.join(self.metrics_dir, METRICS_PROM_FILE)
+        samples = {}
+        try:
+            with open(prom_path, 'r') as f:
+                for line in f:
+                    if line.startswith('#') or not line.strip():
+                        continue
+                    sample, value = line.rstrip('\n').rsplit(' ', 1)
+                    samples[sample] = float(value)
+        except OSError:
+            pass
+
+        def add(name, extra_labels, value):
+            sample = name + prom_labels({**labels, **extra_labels})
+            samples[sample] = samples.get(sample, 0.0) + value
+
+        add('cnab_docker2_operations_total', {'result': result}, 1)
+        for phase, duration in self.phases.items():
+            add('cnab_docker2_phase_seconds_sum', {'phase': phase}, duration)
+            add('cnab_docker2_phase_seconds_count', {'phase': phase}, 1)
+
+        # The samples of each metric must follow its own HELP and TYPE lines.
+        metrics = [
+            ('cnab_docker2_operations_total', 'counter',
+             'Number of operations run by the cnab-docker2 driver.'),
+            ('cnab_docker2_phase_seconds', 'summary',
+             'Time spent in each phase of the operations run by the ' +
+             'cnab-docker2 driver.'),
+        ]
+        lines = []
+        for name, metric_type, description in metrics:
+            lines += [
+                f'# HELP {name} {description}',
+                f'# TYPE {name} {metric_type}',
+            ]
+            lines += [
+                f'{sample} {samples[sample]!r}'
+                for sample in sorted(samples)
+                if re.match(re.escape(name) + r'(_sum|_count)?(\{|$)', sample)
+            ]
+        tmp_path = f'{prom_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, prom_path)
+
+    @contextlib.contextmanager
+    def _lock(self, timeout=10):
+        """
+        Serializes the updates of the Prometheus textfile between concurrent
+        driver invocations.  A lock older than the timeout is considered
+        stale and is broken.
+        """
+        lock_path = os.path.join(self.metrics_dir, METRICS_PROM_FILE + '.lock')
+        deadline = time.time() + timeout
+        while True:
+            try:
+                os.mkdir(lock_path)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_path) > timeout:
+                        os.rmdir(lock_path)
+                        continue
+                except OSError:
+                    continue
+                if time.time() > deadline:
+                    raise TimeoutError(f"cannot acquire lock '{lock_path}'")
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            os.rmdir(lock_path)
+
+
+def prom_labels(labels):
+    """
+    Formats labels for the Prometheus text format.
+    """
+    return '{' + ','.join(
+        f'{name}="' + labels[name].replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n') + '"'
+        for name in sorted(labels)) + '}'
+
+
+def docker_run_flags(config, volumes):
+    """
+    Returns the flags to "docker run" that are common to one-shot and
+    warm pool containers.
+    """
+    args = []
+    if config.allow_docker_host_access:
+        args += ['--privileged', '--net', 'host']
+    for v in volumes:
+        args += ['-v', v]
+    return args
+
+
+def copy_files_into_container(container, files):
+    """
+    Copies file parameters into a container, as a single tar stream.
+
+    Args:
+        container: The ID of the container.
+        files: A map of container paths to file contents.
+    """
+    p = subprocess.Popen(['docker', 'cp', '-', container + ':/'],
+                         stdin=subprocess.PIPE,
+                         stdout=sys.stderr.buffer)
+    try:
+        with tarfile.open(fileobj=p.stdin, mode='w|') as tar:
+            now = time.time()
+            for container_path in files:
+                reader = Utf8Reader(files[container_path])
+                info = tarfile.TarInfo(container_path.lstrip('/'))
+                info.size = reader.size
+                info.mode = 0o444
+                info.mtime = now
+                tar.addfile(info, reader)
+    finally:
+        p.stdin.close()
+        returncode = p.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, p.args)
+
+
+class Utf8Reader:
+    """
+    Binary file-like object that reads a string as UTF-8, encoding it chunk
+    by chunk, so that the content is never encoded all at once (see
+    WRITE_CHUNK_SIZE).
+    """
+
+    def __init__(self, content):
+        self.content = content
+        self.position = 0
+        self.buffer = b''
+        self.buffer_offset = 0
+        if content.isascii():
+            self.size = len(content)
+        else:
+            self.size = sum(
+                len(content[i:i + WRITE_CHUNK_SIZE].encode('utf8'))
+                for i in range(0, len(content), WRITE_CHUNK_SIZE))
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self.buffer_offset == len(self.buffer):
+                if self.position >= len(self.content):
+                    break
+                self.buffer = self.content[self.position:self.position +
+                                           WRITE_CHUNK_SIZE].encode('utf8')
+                self.buffer_offset = 0
+                self.position += WRITE_CHUNK_SIZE
+            end = len(self.buffer) if size < 0 else min(
+                len(self.buffer), self.buffer_offset + size)
+            chunks.append(self.buffer[self.buffer_offset:end])
+            if size > 0:
+                size -= end - self.buffer_offset
+            self.buffer_offset = end
+        return b''.join(chunks)
+
+
+def pool_state_dir():
+    """
+    Returns the folder where the last-use times of the warm pool
+    containers are recorded.
+    """
+    state_dir = os.environ.get('CNAB_DOCKER2_POOL_DIR',
+                               os.path.expanduser('~/.cnab-docker2/pool'))
+    os.makedirs(state_dir, exist_ok=True)
+    return state_dir
+
+
+def pool_key(operation, config, volumes):
+    """
+    Returns the key of the warm pool containers that can run an operation:
+    containers are shared between operations with the same image, mount set,
+    and bundle parameters.  The environment is not part of the key, as
+    Duffle puts per-operation values in it (e.g., "CNAB_ACTION" and
+    "CNAB_REVISION"): it is given to each "docker exec" instead.
+    """
+    key = json.dumps(
+        {
+            'image': operation['image']['image'],
+            'volumes': volumes,
+            'allowDockerHostAccess': config.allow_docker_host_access,
+            'parameters': operation.get('parameters') or {},
+        },
+        sort_keys=True)
+    return hashlib.sha256(key.encode('utf8')).hexdigest()[:32]
+
+
+def list_pool_containers():
+    """
+    Lists the warm pool containers.
+
+    Return:
+        A list of maps with the "id" (the name), "key", "idleTimeout",
+        "running", "lastUsed" and "busy" of the containers.
+    """
+    p = subprocess.run([
+        'docker', 'ps', '--all', '--no-trunc', '--filter',
+        f'label={POOL_LABEL}', '--format', '{{.Names}}\t{{.Label "' +
+        POOL_LABEL + '"}}\t{{.Label "' + POOL_IDLE_TIMEOUT_LABEL +
+        '"}}\t{{.Status}}'
+    ],
+                       capture_output=True,
+                       encoding='utf8',
+                       check=True)
+    state_dir = pool_state_dir()
+    containers = []
+    for line in p.stdout.splitlines():
+        container_id, key, idle_timeout, status = line.split('\t')
+        try:
+            last_used = os.path.getmtime(os.path.join(state_dir, container_id))
+        except OSError:
+            last_used = 0
+        containers.append({
+            'id': container_id,
+            'key': key,
+            'idleTimeout': float(idle_timeout or 0),
+            'running': status.startswith('Up'),
+            'lastUsed': last_used,
+            'busy': is_pool_container_claimed(container_id),
+        })
+    return containers
+
+
+def claim_pool_container(container_id):
+    """
+    Claims a warm pool container for the current operation, so that no other
+    operation is run in it concurrently.
+
+    Return:
+        Whether the container could be claimed.
+    """
+    busy_file = os.path.join(pool_state_dir(), container_id + '.busy')
+    try:
+        fd = os.open(busy_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+    except FileExistsError:
+        return False
+    with open(fd, 'w') as f:
+        f.write(str(os.getpid()))
+    return True
+
+
+def release_pool_container(container_id):
+    """
+    Releases a warm pool container claimed with [[claim_pool_container]].
+    """
+    try:
+        os.remove(os.path.join(pool_state_dir(), container_id + '.busy'))
+    except OSError:
+        pass
+
+
+def is_pool_container_claimed(container_id):
+    """
+    Returns whether a warm pool container is claimed by an operation.  Claims
+    of driver processes that do not exist anymore are released.
+    """
+    busy_file = os.path.join(pool_state_dir(), container_id + '.busy')
+    try:
+        with open(busy_file, 'r') as f:
+            pid = int(f.read() or 0)
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError):
+        return True
+    if pid and not pid_exists(pid):
+        release_pool_container(container_id)
+        return False
+    return True
+
+
+def pid_exists(pid):
+    """
+    Returns whether a process exists.  Always "True" on Windows, where
+    "os.kill" cannot be used to check for a process.
+    """
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def remove_pool_containers(container_ids):
+    """
+    Removes warm pool containers, and their state.
+    """
+    if not container_ids:
+        return
+    subprocess.run(['docker', 'rm', '--force'] + container_ids,
+                   stdout=subprocess.DEVNULL,
+                   stderr=sys.stderr.buffer)
+    state_dir = pool_state_dir()
+    for container_id in container_ids:
+        for path in [container_id, container_id + '.busy']:
+            try:
+                os.remove(os.path.join(state_dir, path))
+            except OSError:
+                pass
+
+
+def prune_pool():
+    """
+    Removes the warm pool containers that are stopped or that have been idle
+    for longer than their idle timeout.
+
+    Return:
+        The remaining warm pool containers (see [[list_pool_containers]]).
+    """
+    now = time.time()
+    remaining = []
+    to_remove = []
+    for c in list_pool_containers():
+        if not c['busy'] and (not c['running'] or
+                              now - c['lastUsed'] > c['idleTimeout']) and \
+                claim_pool_container(c['id']):
+            to_remove.append(c['id'])
+        else:
+            remaining.append(c)
+    remove_pool_containers(to_remove)
+    return remaining
+
+
+def acquire_pool_container(operation, config, volumes):
+    """
+    Gets and claims a running warm pool container for an operation, creating
+    it if needed.  A container is never given to an operation while another
+    operation runs in it.
+
+    Return:
+        The ID of the container, or "None" if the pool is full of busy
+        containers.
+    """
+    key = pool_key(operation, config, volumes)
+    containers = prune_pool()
+    for c in containers:
+        if c['key'] == key and not c['busy'] and claim_pool_container(c['id']):
+            return c['id']
+
+    idle = sorted((c for c in containers if not c['busy']),
+                  key=lambda c: c['lastUsed'])
+    excess = len(containers) - config.warm_pool_max_size + 1
+    if excess > len(idle):
+        return None
+    if excess > 0:
+        # Claim the containers to evict, so that they are not given to other
+        # operations in the meantime.
+        evicted = [c['id'] for c in idle if claim_pool_container(c['id'])]
+        if len(evicted) < excess:
+            for container_id in evicted:
+                release_pool_container(container_id)
+            return None
+        for container_id in evicted[excess:]:
+            release_pool_container(container_id)
+        remove_pool_containers(evicted[:excess])
+
+    # Claim the container, and record its last use, before it is created,
+    # so that it is never pruned by another driver in the meantime.
+    container = POOL_NAME_PREFIX + os.urandom(8).hex()
+    if not claim_pool_container(container):
+        raise Exception(f"cannot claim warm pool container '{container}'")
+    state_file = os.path.join(pool_state_dir(), container)
+    try:
+        open(state_file, 'a').close()
+        args = [
+            'docker', 'run', '--detach', '--name', container, '--label',
+            f'{POOL_LABEL}={key}', '--label',
+            f'{POOL_IDLE_TIMEOUT_LABEL}={config.warm_pool_idle_timeout}'
+        ]
+        args += docker_run_flags(config, volumes)
+        args += [
+            '--entrypoint', '/bin/sh', operation['image']['image'], '-c',
+            POOL_KEEPALIVE_SCRIPT.format(
+                idle_timeout=int(config.warm_pool_idle_timeout))
+        ]
+        subprocess.run(args,
+                       stdout=subprocess.DEVNULL,
+                       stderr=sys.stderr.buffer,
+                       check=True)
+    except BaseException:
+        remove_pool_containers([container])
+        raise
+    return container
+
+
+def run_in_pool(operation, config, volumes, env_flags, metrics):
+    """
+    Runs an operation with "docker exec" in a warm pool container.  The
+    environment of the operation is given to "docker exec", as the container
+    is shared with other operations.
+
+    Return:
+        "False" if the pool is full of busy containers, in which case the
+        operation has not been run.
+    """
+    with metrics.phase('create'):
+        container = acquire_pool_container(operation, config, volumes)
+    if not container:
+        return False
+
+    state_file = os.path.join(pool_state_dir(), container)
+    try:
+        open(state_file, 'a').close()
+        os.utime(state_file)
+        with metrics.phase('staging'):
+            if len(operation['files']) > 0:
+                copy_files_into_container(container, operation['files'])
+        try:
+            with metrics.phase('runtime'):
+                subprocess.run(['docker', 'exec'] + env_flags + [
+                    container, '/bin/sh', '-c', POOL_EXEC_SCRIPT, 'sh',
+                    '/cnab/app/run', operation['action']
+                ],
+                               check=True,
+                               stdout=sys.stderr.buffer,
+                               stderr=sys.stderr.buffer)
+        finally:
+            # Do not leave the files of this operation to the next one.
+            if len(operation['files']) > 0:
+                with metrics.phase('teardown'):
+                    subprocess.run(
+                        ['docker', 'exec', container, 'rm', '-f'] +
+                        list(operation['files']),
+                        stdout=subprocess.DEVNULL,
+                        stderr=sys.stderr.buffer)
+    finally:
+        os.utime(state_file)
+        release_pool_container(container)
+    return True
 
 
 if __name__ == "__main__":